@@ -0,0 +1,69 @@
+"""bdist_nsi
+
+Importing this package registers the Distutils 'bdist_nsi' command. The
+command itself, in bdist_nsi.bdist_nsi, is only imported when distutils
+looks it up, so setup scripts which do not build an installer do not
+pay for it.
+"""
+
+import sys
+
+class CommandFinder(object):
+    """Import hook which provides distutils.command.bdist_nsi, by
+    importing bdist_nsi.bdist_nsi on first use.
+    """
+
+    name = 'distutils.command.bdist_nsi'
+
+    def import_command(self):
+        """Import bdist_nsi.bdist_nsi. Distutils reports any ImportError
+        as an invalid command, so import errors from within the module,
+        such as a missing dependency, are raised as DistutilsModuleError.
+        """
+        try:
+            __import__('bdist_nsi.bdist_nsi')
+        except ImportError:
+            error = sys.exc_info()[1]
+            if 'bdist_nsi.bdist_nsi' in sys.modules:
+                del sys.modules['bdist_nsi.bdist_nsi']
+            if getattr(error, 'name', None) in ('bdist_nsi',
+                                                'bdist_nsi.bdist_nsi'):
+                raise
+            from distutils.errors import DistutilsModuleError
+            raise DistutilsModuleError(
+                "cannot import bdist_nsi.bdist_nsi: %s" % error)
+        return sys.modules['bdist_nsi.bdist_nsi']
+
+    # python 3.4 and later
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname != self.name:
+            return None
+        import importlib.util
+        return importlib.util.spec_from_loader(fullname, self)
+
+    def create_module(self, spec):
+        return self.import_command()
+
+    def exec_module(self, module):
+        pass
+
+    # python 2.x
+
+    def find_module(self, fullname, path=None):
+        if fullname != self.name:
+            return None
+        return self
+
+    def load_module(self, fullname):
+        module = self.import_command()
+        sys.modules[fullname] = module
+        return module
+
+if not any(isinstance(finder, CommandFinder) for finder in sys.meta_path):
+    sys.meta_path.append(CommandFinder())
+
+# list the command with --help-commands, if distutils is already loaded
+if 'distutils.command' in sys.modules:
+    if 'bdist_nsi' not in sys.modules['distutils.command'].__all__:
+        sys.modules['distutils.command'].__all__.append('bdist_nsi')
@@ -23,21 +23,32 @@ Implements the Distutils 'bdist_nsi' command: create a Windows NSIS installer.
 #   - added support for Blender 2.5x
 #   - added productkey option
 
-import sys, os, string
+import sys, os, string, re
+import base64
+import csv
+import marshal
+import zipfile
+import fnmatch
+import glob
+import math
+import json
+import time
+import hashlib
+import struct
+import random
+import tempfile
 import subprocess
+import multiprocessing
 from distutils.core import Command
 from distutils.util import get_platform
-from distutils.dir_util import create_tree, remove_tree
+from distutils.dir_util import create_tree, remove_tree, copy_tree
+from distutils.file_util import copy_file
 from distutils.errors import *
 from distutils.sysconfig import get_python_version
 from distutils import log
 from distutils.spawn import spawn
 from distutils.command.install import WINDOWS_SCHEME
 
-from distutils import command
-command.__all__.append('bdist_nsi')
-sys.modules['distutils.command.bdist_nsi'] = sys.modules[__name__]
-
 class RegKey:
     """Stores the location of a registry key."""
 
@@ -488,6 +499,979 @@ class Blender25xAppInfo(BlenderAppInfo):
                % (self.label, self.py_version, self.version))
         yield '!macroend'
 
+def get_magic():
+    """Return the bytecode magic number of the running interpreter.
+
+    >>> len(get_magic())
+    4
+    """
+    try:
+        from importlib.util import MAGIC_NUMBER
+    except ImportError:
+        import imp
+        return imp.get_magic()
+    return MAGIC_NUMBER
+
+def get_bytecode_path(source, optimize=0):
+    """Return the path of the bytecode file which compileall writes for
+    source, when run without -OO (optimize=0) or with -OO (optimize=2).
+    """
+    if sys.version_info >= (3, 5):
+        from importlib.util import cache_from_source
+        return cache_from_source(source, optimization=optimize or '')
+    elif sys.version_info >= (3, 2):
+        from imp import cache_from_source
+        return cache_from_source(source, debug_override=not optimize)
+    else:
+        return source + ('o' if optimize else 'c')
+
+def get_bytecode_header(source):
+    """Return the bytecode file header of the running interpreter for
+    the given source file (magic, flags, and source mtime and size).
+
+    >>> header = get_bytecode_header(__file__)
+    >>> header[:4] == get_magic()
+    True
+    """
+    stat = os.stat(source)
+    mtime = struct.pack('<I', int(stat.st_mtime) & 0xFFFFFFFF)
+    size = struct.pack('<I', stat.st_size & 0xFFFFFFFF)
+    if sys.version_info >= (3, 7):
+        return get_magic() + b'\0\0\0\0' + mtime + size
+    elif sys.version_info >= (3, 3):
+        return get_magic() + mtime + size
+    else:
+        return get_magic() + mtime
+
+def get_bytecode_key(data, optimize=0):
+    """Return the cache key for bytecode compiled from the given source
+    data, with the given optimization level, by the running interpreter.
+
+    >>> get_bytecode_key(b"x = 1") == get_bytecode_key(b"x = 1")
+    True
+    >>> get_bytecode_key(b"x = 1") == get_bytecode_key(b"x = 2")
+    False
+    >>> get_bytecode_key(b"x = 1") == get_bytecode_key(b"x = 1", optimize=2)
+    False
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(get_magic())
+    sha1.update(str(optimize).encode("ascii"))
+    sha1.update(data)
+    return sha1.hexdigest()
+
+BYTECODE_SIZE_RATIO = {0: 1.25, 2: 1.05}
+"""Estimated size of bytecode relative to the size of its source, for
+each optimization level (on the safe side, recent Python versions
+produce the largest bytecode).
+"""
+
+def round4k(x):
+    """Round number up to closest 4k boundary (disk space is allocated
+    in chunks of 4k so this 'fixes' the file size).
+
+    >>> round4k(1)
+    4096
+    >>> round4k(5000)
+    8192
+    """
+    return (1 + (x // 4096)) * 4096
+
+def get_tree_size(path):
+    """Disk space taken by the file, or the folder, at path."""
+    if not os.path.isdir(path):
+        return round4k(os.path.getsize(path))
+    return sum(
+        sum(round4k(os.path.getsize(os.path.join(dirpath, filename)))
+            for filename in filenames)
+        for dirpath, dirnames, filenames in os.walk(path))
+
+COMPILE_SCRIPT = """\
+import sys, py_compile
+for line in sys.stdin:
+    source, cfile = line.rstrip('\\n').split('\\t')
+    try:
+        py_compile.compile(source, cfile, doraise=True)
+    except py_compile.PyCompileError as e:
+        sys.stderr.write(str(e) + '\\n')
+    sys.stdout.write(source + '\\n')
+    sys.stdout.flush()
+"""
+"""Script which compiles the (source, cfile) pairs given on stdin,
+one tab separated pair per line, writing each source to stdout once
+done.
+"""
+
+SHEBANG_SCRIPT = (
+    "import sys, os;"
+    " f = open(sys.argv[1], 'rb'); d = f.read().decode('latin-1');"
+    " f.close(); w = d[2:].split()[0];"
+    " e = sys.executable;"
+    " e = [e, os.path.join(os.path.dirname(e), 'pythonw.exe')][w == 'pythonw'];"
+    " e = [e, chr(34) + e + chr(34)][' ' in e];"
+    " f = open(sys.argv[1], 'wb');"
+    " f.write(('#!' + e + d[2 + len(w):]).encode('latin-1')); f.close()")
+"""Script which points the #!python or #!pythonw line of the script
+given as argument at the running interpreter, as wheel installers do.
+Python 2 and 3 compatible, without double quotes or backticks, so it
+fits on the command line of nsExec.
+"""
+
+class BuildCache:
+    """Content addressed file cache which can be shared between builds
+    and projects. Least recently used entries are evicted once the cache
+    exceeds its maximum size.
+
+    >>> import tempfile
+    >>> cache = BuildCache(tempfile.mkdtemp(), max_size=10)
+    >>> cache.get("0123abcd") is None
+    True
+    >>> cache.put("0123abcd", b"12345678")
+    >>> open(cache.get("0123abcd"), "rb").read() == b"12345678"
+    True
+    >>> cache.put("4567abcd", b"12345678")
+    >>> cache.prune()
+    >>> cache.get("0123abcd") is None
+    True
+    >>> remove_tree(cache.directory)
+    """
+
+    directory = None
+    """Folder where the cache entries are stored."""
+
+    max_size = None
+    """Maximum total size of all entries, in bytes."""
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        """Initialize cache."""
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_path(self, key):
+        """Path of the file for the given key."""
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return path to the file stored under key, or None if there is
+        no such file. Marks the entry as recently used.
+        """
+        path = self.get_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Store data under key. Concurrent writers of the same key are
+        harmless since keys are derived from the content.
+        """
+        path = self.get_path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass # created meanwhile by another build
+        tmppath = "%s.%i.tmp" % (path, os.getpid())
+        tmpfile = open(tmppath, "wb")
+        tmpfile.write(data)
+        tmpfile.close()
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # on windows, rename fails if another build stored it first
+            os.remove(tmppath)
+
+    def prune(self):
+        """Remove least recently used entries until the total size of the
+        cache does not exceed max_size.
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def file_sha1(path):
+    """Return the sha1 hex digest of the contents of a file."""
+    sha1 = hashlib.sha1()
+    stream = open(path, 'rb')
+    for chunk in iter(lambda: stream.read(65536), b''):
+        sha1.update(chunk)
+    stream.close()
+    return sha1.hexdigest()
+
+def get_install_path(path):
+    r"""Return the install path of a file in the staging folder, in terms
+    of the install variables $3, $4, and $5, or None if it is not
+    installed.
+
+    >>> print(get_install_path("Lib\\site-packages\\foo\\bar.py"))
+    $3\foo\bar.py
+    >>> print(get_install_path("Scripts\\foo.py"))
+    $4\foo.py
+    >>> print(get_install_path("Include\\foo\\foo.h"))
+    $5\foo\foo.h
+    >>> print(get_install_path("foo.txt"))
+    None
+    """
+    for prefix, variable in (("lib\\site-packages\\", "$3"),
+                             ("scripts\\", "$4"),
+                             ("include\\", "$5")):
+        if path.lower().startswith(prefix):
+            return "%s\\%s" % (variable, path[len(prefix):])
+    return None
+
+def wrap_payload(commands, version, tag):
+    r"""Wrap NSIS commands so they are only run if the python version $2
+    matches version, which is either a full version such as "3.4", or
+    a major version such as "3".
+
+    >>> print("".join(wrap_payload(["  Nop\n"], "3.4", "payload_3_4")))
+      ; python 3.4
+      StrCmp $2 "3.4" 0 end_payload_3_4
+      Nop
+    end_payload_3_4:
+    <BLANKLINE>
+    <BLANKLINE>
+    """
+    if "." in version:
+        head = [
+            '  ; python %s\n' % version,
+            '  StrCmp $2 "%s" 0 end_%s\n' % (version, tag)]
+    else:
+        head = [
+            '  ; python %s.x\n' % version,
+            '  Push $9\n',
+            '  StrCpy $9 "$2" %i\n' % len(version),
+            '  StrCmp $9 "%s" %s 0\n' % (version, tag),
+            '  Pop $9\n',
+            '  Goto end_%s\n' % tag,
+            '%s:\n' % tag,
+            '  Pop $9\n']
+    return head + commands + ['end_%s:\n\n' % tag]
+
+def get_source_date_epoch():
+    """Return the time stamp for reproducible builds: the
+    SOURCE_DATE_EPOCH environment variable if set, and 1980-01-01
+    otherwise.
+
+    >>> old = os.environ.pop('SOURCE_DATE_EPOCH', None)
+    >>> get_source_date_epoch()
+    315532800
+    >>> os.environ['SOURCE_DATE_EPOCH'] = '1400000000'
+    >>> get_source_date_epoch()
+    1400000000
+    >>> if old is None: del os.environ['SOURCE_DATE_EPOCH']
+    ... else: os.environ['SOURCE_DATE_EPOCH'] = old
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 315532800))
+
+def get_content_time(sha1):
+    """Modification time for a file with the given sha1 hex digest: the
+    same for the same content, in any release, and most likely different
+    for different content. Times are even, as FAT file systems only
+    store even seconds, and after 1980-01-01.
+
+    >>> get_content_time(hashlib.sha1(b"a").hexdigest())
+    598581894
+    >>> get_content_time("0" * 40)
+    315532800
+    """
+    return 315532800 + 2 * int(sha1[:7], 16)
+
+def scan_files(py_dir, epoch=None):
+    r"""Return all files under py_dir, in sorted order, as a list of
+    [folder, file] paths relative to py_dir, with windows separators.
+    If epoch is given, the modification time of every file is set to it,
+    as NSIS stores these times in the installer.
+
+    >>> import tempfile, shutil
+    >>> trees = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    >>> for tree, names in zip(trees, [["b.py", "a/c.py", "a/B.txt"],
+    ...                                ["a/B.txt", "a/c.py", "b.py"]]):
+    ...     for name in names:
+    ...         path = os.path.join(tree, *name.split("/"))
+    ...         if not os.path.isdir(os.path.dirname(path)):
+    ...             os.mkdir(os.path.dirname(path))
+    ...         open(path, "w").close()
+    >>> scan_files(trees[0], 315532800) == scan_files(trees[1], 315532800)
+    True
+    >>> for each in scan_files(trees[0]):
+    ...     print(each[1])
+    b.py
+    a\B.txt
+    a\c.py
+    >>> [int(os.path.getmtime(os.path.join(tree, "a", "c.py")))
+    ...  for tree in trees]
+    [315532800, 315532800]
+    >>> for tree in trees:
+    ...     shutil.rmtree(tree)
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(py_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if epoch is not None:
+                os.utime(path, (epoch, epoch))
+            f = os.path.relpath(path, py_dir).replace(os.sep, "\\")
+            files.append([f.rpartition("\\")[0], f])
+    return files
+
+def get_import_times(module):
+    """Return the import time in microseconds of module, and of all the
+    modules it imports (including their imports), measured in a fresh
+    interpreter with -X importtime (python 3.7 or later).
+
+    Importing the bdist_nsi package must only register the command, so
+    it stays well within its budget, and does not import distutils:
+
+    >>> times = get_import_times("bdist_nsi")
+    >>> times["bdist_nsi"] < 50000
+    True
+    >>> [name for name in times if name.startswith("distutils")]
+    []
+    >>> "bdist_nsi.bdist_nsi" in times
+    False
+    """
+    # run from the folder containing the bdist_nsi package
+    process = subprocess.Popen(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    stderr = process.communicate()[1]
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            fields = line[len("import time:"):].split("|")
+            if fields[1].strip().isdigit():
+                times[fields[2].strip()] = int(fields[1])
+    return times
+
+# extensions of files whose contents are already compressed
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.7z', '.rar', '.cab',
+    '.whl', '.egg', '.jar', '.npz', '.png', '.jpg', '.jpeg', '.gif',
+    '.mp3', '.ogg', '.mp4', '.avi', '.webm', '.webp',
+    ])
+
+def get_entropy(data):
+    """Return the entropy of data in bits per byte.
+
+    >>> get_entropy(b"aaaa")
+    0.0
+    >>> get_entropy(bytes(bytearray(range(256))))
+    8.0
+    """
+    if not data:
+        return 0.0
+    counts = [0] * 256
+    for byte in bytearray(data):
+        counts[byte] += 1
+    entropy = 0.0
+    for count in counts:
+        if count:
+            entropy -= count * math.log(float(count) / len(data), 2)
+    return entropy / len(data)
+
+def is_incompressible(path, min_size=16384, sample_size=4096,
+                      max_entropy=7.5):
+    r"""Return whether the file is unlikely to compress, either from its
+    extension, or for files of at least min_size bytes, from the entropy
+    of samples at its start, middle, and end.
+
+    >>> import tempfile, shutil
+    >>> folder = tempfile.mkdtemp()
+    >>> for name, data in [("a.png", b"x"), ("a.dat", os.urandom(65536)),
+    ...                    ("a.txt", b"hello world\n" * 8192)]:
+    ...     with open(os.path.join(folder, name), "wb") as stream:
+    ...         n = stream.write(data)
+    ...     print("%s %s" % (name, is_incompressible(
+    ...         os.path.join(folder, name))))
+    a.png True
+    a.dat True
+    a.txt False
+    >>> shutil.rmtree(folder)
+    """
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    size = os.path.getsize(path)
+    if size < min_size:
+        return False
+    stream = open(path, 'rb')
+    samples = []
+    for offset in (0, (size - sample_size) // 2, size - sample_size):
+        stream.seek(offset)
+        samples.append(stream.read(sample_size))
+    stream.close()
+    return get_entropy(b''.join(samples)) > max_entropy
+
+def get_filter_rule(path, include=(), exclude=()):
+    """Return the rule which excludes the file at path (relative to its
+    install folder, with / separators), or None if it is kept. If there
+    are include patterns, only files which match one of them are kept.
+    Files which match an exclude pattern are not kept.
+
+    >>> print(get_filter_rule("foo/tests/test_a.py", exclude=["*/tests/*"]))
+    exclude */tests/*
+    >>> print(get_filter_rule("foo/a.py", exclude=["*/tests/*", "*.c"]))
+    None
+    >>> print(get_filter_rule("foo/a.c", include=["foo/*"], exclude=["*.c"]))
+    exclude *.c
+    >>> print(get_filter_rule("bar/a.py", include=["foo/*"]))
+    include foo/*
+    """
+    if include and not any(fnmatch.fnmatch(path, pattern)
+                           for pattern in include):
+        return "include %s" % ", ".join(include)
+    for pattern in exclude:
+        if fnmatch.fnmatch(path, pattern):
+            return "exclude %s" % pattern
+    return None
+
+def get_components(roots, required=(), groups=()):
+    """Return the roots (the folders and files in site-packages) which
+    are always installed, and the optional components, as (name, roots)
+    tuples. Roots are named without extension, so for instance a zip
+    file and its .pth file are one component. The roots whose name
+    matches one of the patterns of a (name, patterns) tuple in groups
+    form one component, of that name. Components whose name is in
+    required, and metadata, are always installed.
+
+    >>> get_components(["foo", "foo-1.0.egg-info", "foo_data",
+    ...                 "foo_tests", "extra.zip", "extra.pth"],
+    ...                required=["foo"],
+    ...                groups=[("Data and tests", ["*_data", "*_tests"])])
+    (['foo', 'foo-1.0.egg-info'], [('Data and tests', ['foo_data', 'foo_tests']), ('extra', ['extra.pth', 'extra.zip'])])
+    """
+    required_roots = []
+    components = {}
+    for root in sorted(roots):
+        name = root.split('.')[0]
+        for group, patterns in groups:
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                name = group
+                break
+        if (name in required or name == '__pycache__'
+                or root.endswith(('.egg-info', '.dist-info'))):
+            required_roots.append(root)
+        else:
+            components.setdefault(name, []).append(root)
+    return required_roots, sorted(components.items())
+
+def is_zip_safe(path):
+    """Return whether the package folder or module at path can be
+    imported from a zip file: it must only contain python modules (no
+    extension modules or data files), which do not use __file__.
+
+    >>> import tempfile, shutil
+    >>> folder = tempfile.mkdtemp()
+    >>> for name, data in [("a/__init__.py", b"x = 1"),
+    ...                    ("b/__init__.py", b"print(__file__)"),
+    ...                    ("c/__init__.py", b""), ("c/data.txt", b"")]:
+    ...     path = os.path.join(folder, *name.split("/"))
+    ...     if not os.path.isdir(os.path.dirname(path)):
+    ...         os.mkdir(os.path.dirname(path))
+    ...     with open(path, "wb") as stream:
+    ...         n = stream.write(data)
+    >>> [is_zip_safe(os.path.join(folder, name)) for name in "abc"]
+    [True, False, False]
+    >>> shutil.rmtree(folder)
+    """
+    if os.path.isdir(path):
+        filenames = [os.path.join(dirpath, filename)
+                     for dirpath, dirnames, filenames in os.walk(path)
+                     for filename in filenames]
+    else:
+        filenames = [path]
+    for filename in filenames:
+        if not filename.endswith('.py'):
+            return False
+        stream = open(filename, 'rb')
+        data = stream.read()
+        stream.close()
+        if b'__file__' in data:
+            return False
+    return True
+
+def read_install_timing(lines):
+    """Return the durations, in milliseconds, of the phases in the lines
+    of an install timing log, as a dictionary which maps each phase to
+    the list of its durations.
+
+    >>> sorted(read_install_timing(
+    ...     ["100 begin init", "150 end init",
+    ...      "200 begin files packages 2.7", "1200 end files packages 2.7",
+    ...      "4294967290 begin post", "10 end post"]).items())
+    [('files packages 2.7', [1000]), ('init', [50]), ('post', [16])]
+    """
+    starts = {}
+    durations = {}
+    for line in lines:
+        fields = line.split(None, 2)
+        if len(fields) < 3 or not fields[0].isdigit():
+            continue
+        ticks, kind, phase = int(fields[0]), fields[1], fields[2].strip()
+        if kind == 'begin':
+            starts[phase] = ticks
+        elif kind == 'end' and phase in starts:
+            # GetTickCount wraps around after 49.7 days
+            durations.setdefault(phase, []).append(
+                (ticks - starts.pop(phase)) % (2 ** 32))
+    return durations
+
+def report_install_timing(filenames):
+    """Return a report on the install timing logs, as written by
+    installers built with the install-timing option, with the number of
+    installs, the total, the mean, and the maximum time in seconds of
+    each phase, slowest phase first.
+    """
+    durations = {}
+    for filename in filenames:
+        logfile = open(filename, 'rt')
+        for phase, times in read_install_timing(logfile).items():
+            durations.setdefault(phase, []).extend(times)
+        logfile.close()
+    lines = ["%-40s %6s %9s %9s %9s"
+             % ("phase", "count", "total", "mean", "max")]
+    for phase, times in sorted(durations.items(),
+                               key=lambda item: -sum(item[1])):
+        lines.append("%-40s %6i %9.3f %9.3f %9.3f"
+                     % (phase, len(times), sum(times) / 1000.0,
+                        sum(times) / 1000.0 / len(times),
+                        max(times) / 1000.0))
+    return "\n".join(lines)
+
+def get_wheel_target(filename):
+    """Return the target python version (empty for any version) and bits
+    (None for any) of a wheel, from the tags in its file name.
+
+    >>> get_wheel_target("foo-1.0-py2.py3-none-any.whl")
+    ('', None)
+    >>> get_wheel_target("foo-1.0-cp27-cp27m-win32.whl")
+    ('2.7', 32)
+    >>> get_wheel_target("foo-1.0-1-cp311-cp311-win_amd64.whl")
+    ('3.11', 64)
+    >>> get_wheel_target("foo-1.0-cp36-abi3-win_amd64.whl")
+    ('', 64)
+    >>> get_wheel_target("foo-1.0-cp36-cp36m-linux_x86_64.whl") # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    DistutilsOptionError: foo-1.0-cp36-cp36m-linux_x86_64.whl is not a windows wheel
+    """
+    basename = os.path.basename(filename)
+    python_tag, abi_tag, platform_tag = basename[:-4].split('-')[-3:]
+    bits = {'win32': 32, 'win_amd64': 64, 'any': None}.get(platform_tag, 0)
+    if bits == 0:
+        raise DistutilsOptionError("%s is not a windows wheel" % basename)
+    match = re.match(r'^cp(\d)(\d+)$', python_tag)
+    if match and abi_tag != 'abi3':
+        return "%s.%s" % match.groups(), bits
+    return '', bits
+
+def get_interpreter_version(interpreter):
+    """Return the short version, such as 2.7, of a python interpreter.
+
+    >>> get_interpreter_version(sys.executable) == get_python_version()
+    True
+    """
+    try:
+        output = subprocess.check_output(
+            [interpreter, "-c",
+             "import sys; print('%d.%d' % sys.version_info[:2])"],
+            universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        raise DistutilsExecError("cannot run interpreter %s" % interpreter)
+    return output.strip()
+
+def run_parallel(commands, dry_run=0, jobs=None, returncodes=None):
+    """Run the commands in parallel, at most jobs at a time (default: all
+    at once), and return the number of commands which failed.
+
+    >>> run_parallel([[sys.executable, "-c", "pass"],
+    ...               [sys.executable, "-c", "import sys; sys.exit(1)"]])
+    1
+    >>> run_parallel([[sys.executable, "-c", "pass"]] * 3, jobs=2)
+    0
+
+    The return codes, in the order of the commands, are appended to
+    returncodes, if given.
+
+    >>> returncodes = []
+    >>> run_parallel([[sys.executable, "-c", "import sys; sys.exit(2)"],
+    ...               [sys.executable, "-c", "pass"]], jobs=1,
+    ...              returncodes=returncodes)
+    1
+    >>> returncodes
+    [2, 0]
+    """
+    if returncodes is None:
+        returncodes = []
+    start = len(returncodes)
+    processes = []
+    for cmd in commands:
+        log.info(" ".join(cmd))
+        if dry_run:
+            returncodes.append(0)
+            continue
+        if jobs is not None and len(processes) >= jobs:
+            returncodes.append(processes.pop(0).wait())
+        processes.append(subprocess.Popen(cmd))
+    returncodes.extend(process.wait() for process in processes)
+    return sum(1 for returncode in returncodes[start:] if returncode != 0)
+
+def get_run_name(prefix):
+    """A file or folder name for this run, which differs from the names
+    of other runs, also those running at the same time on this host.
+
+    >>> get_run_name('nsi-') != get_run_name('nsi-')
+    True
+    """
+    return "%s%i-%08x" % (prefix, os.getpid(), random.getrandbits(32))
+
+def publish_file(src, dst):
+    """Move src to dst, replacing dst atomically where the platform
+    allows, so dst is never seen partially written.
+
+    >>> folder = tempfile.mkdtemp()
+    >>> src = os.path.join(folder, 'new.tmp')
+    >>> dst = os.path.join(folder, 'setup.exe')
+    >>> for path, data in ((src, 'new'), (dst, 'old')):
+    ...     with open(path, 'w') as f:
+    ...         _ = f.write(data)
+    >>> publish_file(src, dst)
+    >>> sorted(os.listdir(folder))
+    ['setup.exe']
+    >>> print(open(dst).read())
+    new
+    >>> remove_tree(folder)
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # python 2 cannot rename over an existing file on windows
+        if sys.platform == 'win32' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def load_hook(name):
+    """Import the function given as module:function.
+
+    >>> load_hook('os.path:join')('a', 'b') == os.path.join('a', 'b')
+    True
+    >>> load_hook('os.path.join') # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    DistutilsOptionError: hook os.path.join must be given as module:function
+    """
+    module_name, sep, function_name = name.partition(':')
+    if not sep or not module_name or not function_name:
+        raise DistutilsOptionError(
+            "hook %s must be given as module:function" % name)
+    try:
+        __import__(module_name)
+        return getattr(sys.modules[module_name], function_name)
+    except (ImportError, AttributeError):
+        raise DistutilsOptionError("cannot import hook %s" % name)
+
+def format_duration(seconds):
+    """Seconds as minutes and seconds.
+
+    >>> format_duration(7.4)
+    '0:07'
+    >>> format_duration(3725)
+    '62:05'
+    """
+    seconds = int(round(seconds))
+    return "%i:%02i" % (seconds // 60, seconds % 60)
+
+class ConsoleProgress:
+    """Progress hook which writes the start and end of every phase, and
+    at most every interval seconds its progress, with the throughput and
+    the estimated time to completion.
+
+    >>> progress = ConsoleProgress(stream=sys.stdout)
+    >>> progress({'event': 'start', 'phase': 'scan', 'time': 100.0,
+    ...           'total': 400})
+    scan: started, 400 files
+    >>> for done in range(1, 201):
+    ...     progress({'event': 'progress', 'phase': 'scan',
+    ...               'time': 100.0 + done * 0.01, 'done': done,
+    ...               'total': 400})
+    scan: 100/400 files, 100 files/s, eta 0:03
+    scan: 200/400 files, 100 files/s, eta 0:02
+    >>> progress({'event': 'end', 'phase': 'scan', 'time': 104.0,
+    ...           'done': 400})
+    scan: done in 0:04, 400 files, 100 files/s
+    >>> progress({'event': 'start', 'phase': 'stage', 'time': 200.0})
+    stage: started
+    >>> progress({'event': 'progress', 'phase': 'stage', 'time': 202.0,
+    ...           'done': 50})
+    stage: 50 files, 25 files/s
+    """
+
+    def __init__(self, stream=None, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.starts = {}
+        self.last = {}
+
+    def write(self, text):
+        stream = self.stream or sys.stdout
+        stream.write(text + "\n")
+        stream.flush()
+
+    def __call__(self, event):
+        phase = event['phase']
+        now = event['time']
+        if event['event'] == 'start':
+            self.starts[phase] = self.last[phase] = now
+            if event.get('total'):
+                self.write("%s: started, %i files" % (phase, event['total']))
+            else:
+                self.write("%s: started" % phase)
+        elif event['event'] == 'progress':
+            if now - self.last.get(phase, now) < self.interval:
+                return
+            self.last[phase] = now
+            done = event['done']
+            elapsed = now - self.starts.get(phase, now)
+            rate = done / elapsed if elapsed > 0 else 0
+            if not event.get('total'):
+                # no total, so no eta
+                text = "%s: %i files" % (phase, done)
+                if rate:
+                    text += ", %.0f files/s" % rate
+            else:
+                text = "%s: %i/%i files" % (phase, done, event['total'])
+                if rate:
+                    text += ", %.0f files/s, eta %s" % (
+                        rate, format_duration((event['total'] - done) / rate))
+            self.write(text)
+        elif event['event'] == 'end':
+            elapsed = now - self.starts.pop(phase, now)
+            text = "%s: done in %s" % (phase, format_duration(elapsed))
+            if event.get('done'):
+                text += ", %i files" % event['done']
+                if elapsed > 0:
+                    text += ", %.0f files/s" % (event['done'] / elapsed)
+            self.write(text)
+
+def find_manifests(dist_dir, name, suffix):
+    """Return the manifests of the releases of name in dist_dir, as
+    written next to installers whose file name ends with suffix, as a
+    dictionary which maps each version to its manifest. Manifests whose
+    installer is gone are skipped.
+
+    >>> import tempfile
+    >>> dist_dir = tempfile.mkdtemp()
+    >>> for filename, manifest in [
+    ...         ("foo-1.0.win32.manifest.json", ("foo", "1.0")),
+    ...         ("foo-1.1.win32.manifest.json", ("foo", "1.1")),
+    ...         ("foo-1.1.win-amd64.manifest.json", ("foo", "1.1")),
+    ...         ("foobar-1.0.win32.manifest.json", ("foobar", "1.0"))]:
+    ...     manifest_file = open(os.path.join(dist_dir, filename), 'wt')
+    ...     json.dump({'name': manifest[0], 'version': manifest[1],
+    ...                'files': {}}, manifest_file)
+    ...     manifest_file.close()
+    ...     if manifest[1] == "1.1":
+    ...         open(os.path.join(dist_dir, filename.replace(
+    ...             ".manifest.json", ".exe")), 'w').close()
+    >>> sorted(find_manifests(dist_dir, "foo", ".win32"))
+    ['1.1']
+    >>> sorted(find_manifests(dist_dir, "foo", ".win32-py2.7"))
+    []
+    >>> remove_tree(dist_dir)
+    """
+    manifests = {}
+    for filename in sorted(glob.glob(
+            os.path.join(dist_dir, "*%s.manifest.json" % suffix))):
+        if not os.path.exists(
+                filename[:-len(".manifest.json")] + ".exe"):
+            continue
+        manifest_file = open(filename, 'rt')
+        manifest = json.load(manifest_file)
+        manifest_file.close()
+        if manifest.get('name') == name:
+            manifests.setdefault(manifest['version'], manifest)
+    return manifests
+
+def find_build_trees(build_base, plat_name=None):
+    """Find the per version build trees in build_base, as a dictionary
+    mapping python version to (build_lib, build_scripts), where
+    build_scripts is None if there is no scripts folder for the version.
+    If there are trees for several platforms, then only those for
+    plat_name are used.
+
+    >>> import tempfile
+    >>> build_base = tempfile.mkdtemp()
+    >>> for name in ["lib.win32-2.7", "lib.win-amd64-cpython-34",
+    ...              "scripts-2.7", "temp.win32-2.7", "lib"]:
+    ...     os.mkdir(os.path.join(build_base, name))
+    >>> trees = find_build_trees(build_base)
+    >>> sorted(trees)
+    ['2.7', '3.4']
+    >>> os.path.basename(trees['2.7'][0]), os.path.basename(trees['2.7'][1])
+    ('lib.win32-2.7', 'scripts-2.7')
+    >>> os.path.basename(trees['3.4'][0]), trees['3.4'][1]
+    ('lib.win-amd64-cpython-34', None)
+    >>> os.mkdir(os.path.join(build_base, "lib.win-amd64-2.7"))
+    >>> find_build_trees(build_base) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    DistutilsOptionError: build trees for several platforms found in ...
+    >>> os.path.basename(find_build_trees(build_base, "win32")['2.7'][0])
+    'lib.win32-2.7'
+    >>> remove_tree(build_base)
+    """
+    trees = {}
+    for name in sorted(os.listdir(build_base)):
+        match = (re.match(r'^lib\.(.+)-cpython-(\d)(\d+)$', name)
+                 or re.match(r'^lib\.(.+)-(\d)\.(\d+)$', name))
+        if not match:
+            continue
+        plat, version = match.group(1), "%s.%s" % match.group(2, 3)
+        trees.setdefault(version, {})[plat] = os.path.join(build_base, name)
+    result = {}
+    for version, build_libs in trees.items():
+        if len(build_libs) > 1:
+            if plat_name not in build_libs:
+                raise DistutilsOptionError(
+                    "build trees for several platforms found in %s,"
+                    " specify one with --plat-name" % build_base)
+            build_lib = build_libs[plat_name]
+        else:
+            build_lib = list(build_libs.values())[0]
+        build_scripts = os.path.join(build_base, 'scripts-%s' % version)
+        if not os.path.isdir(build_scripts):
+            build_scripts = None
+        result[version] = build_lib, build_scripts
+    return result
+
+def analyze_nsi(nsiscript, regions=None, top=10):
+    r"""Return a report on the size of the NSIS script nsiscript, as a
+    dictionary which can be saved as JSON. Macros, the lines of each
+    application (found from its PATH_ variable), language lines, and
+    nsExec lines are found by scanning the script; regions maps extra
+    names to (text, count) pairs, for text substituted count times.
+
+    >>> report = analyze_nsi(
+    ...     'var PATH_python_2_7_32\n'
+    ...     '!macro GET_REGISTRY_KEYS_python_2_7_32 if_found\n'
+    ...     '  Nop\n'
+    ...     '!macroend\n'
+    ...     '!insertmacro GET_REGISTRY_KEYS_python_2_7_32 found\n'
+    ...     '!insertmacro MUI_LANGUAGE "English"\n'
+    ...     '  SetOutPath "$3\\foo"\n'
+    ...     '  File "_python\\Lib\\site-packages\\foo\\a.py"\n'
+    ...     '  File "_python\\Lib\\site-packages\\foo\\b.py"\n'
+    ...     '  Delete "$3\\foo\\a.py"\n'
+    ...     '  nsExec::ExecToLog "$1 -c pass"\n',
+    ...     regions={'_deletefiles': ('  Delete "$3\\foo\\a.py"\n', 2)})
+    >>> report['lines'], report['bytes']
+    (11, 340)
+    >>> print(json.dumps(report['commands'], sort_keys=True))
+    {"Delete": 1, "File": 2, "SetOutPath": 1, "nsExec": 1}
+    >>> print(json.dumps(report['macros'], sort_keys=True))
+    {"GET_REGISTRY_KEYS_python_2_7_32": {"bytes": 6, "lines": 1, "uses": 1}}
+    >>> for name, region in sorted(report['regions'].items()):
+    ...     print("%s %i %i" % (name, region['lines'], region['bytes']))
+    _deletefiles 2 46
+    app:python_2_7_32 5 138
+    languages 1 36
+    nsexec 1 33
+    >>> print(json.dumps(report['directories'], sort_keys=True))
+    [{"bytes": 133, "commands": 4, "directory": "$3\\foo"}]
+    """
+    lines = nsiscript.splitlines(True)
+    labels = re.findall(r'^var PATH_(\w+)$', nsiscript, re.MULTILINE)
+    label_re = re.compile(
+        r'(?:^|[^A-Za-z0-9])(%s)(?!\w)' % '|'.join(labels or ['(?!)']))
+    command_re = re.compile(r'^\s*(File|Delete|SetOutPath|nsExec)\b')
+    report = {
+        'lines': len(lines),
+        'bytes': len(nsiscript),
+        'commands': {},
+        'macros': {},
+        'regions': {},
+        'directories': [],
+        }
+
+    def add(table, name, line, count=1):
+        entry = table.setdefault(name, {'lines': 0, 'bytes': 0})
+        entry['lines'] += count * line.count('\n')
+        entry['bytes'] += count * len(line)
+
+    macro = None
+    macro_labels = set()
+    outpath = None
+    directories = {}
+    for line in lines:
+        words = line.split()
+        # macros, and the application they belong to
+        if words[:1] == ['!macro']:
+            macro = words[1]
+            report['macros'][macro] = {'lines': 0, 'bytes': 0, 'uses': 0}
+            macro_labels = set(label_re.findall(macro))
+        elif words[:1] == ['!macroend']:
+            macro = None
+        elif macro is not None:
+            add(report['macros'], macro, line)
+        if words[:1] == ['!insertmacro'] and words[1] in report['macros']:
+            report['macros'][words[1]]['uses'] += 1
+        line_labels = set(label_re.findall(line))
+        if macro is not None or words[:1] == ['!macroend']:
+            line_labels |= macro_labels
+        for label in line_labels:
+            add(report['regions'], 'app:' + label, line)
+        if 'MUI_LANGUAGE' in line or 'LANGDLL' in line:
+            add(report['regions'], 'languages', line)
+        # commands, and the directories they act on
+        match = command_re.match(line)
+        if match:
+            command = match.group(1)
+            report['commands'][command] = (
+                report['commands'].get(command, 0) + 1)
+            if command == 'nsExec':
+                add(report['regions'], 'nsexec', line)
+                continue
+            path = line.split('"')[1] if '"' in line else ''
+            if command == 'SetOutPath':
+                outpath = path
+                directory = path
+            elif command == 'File':
+                directory = outpath
+            else:
+                directory = path.rpartition('\\')[0]
+            if directory:
+                add(directories, directory, line)
+    for name, (text, count) in (regions or {}).items():
+        add(report['regions'], name, text, count)
+    report['directories'] = [
+        {'directory': directory,
+         'commands': entry['lines'],
+         'bytes': entry['bytes']}
+        for directory, entry in sorted(
+            directories.items(),
+            key=lambda item: (-item[1]['bytes'], item[0]))[:top]]
+    return report
+
 class bdist_nsi(Command):
 
     description = "create an executable installer for MS Windows, using NSIS"
@@ -523,7 +1507,7 @@ class bdist_nsi(Command):
                     ('skip-build', None,
                      "skip rebuilding everything (for testing/debugging)"),
                     ('run2to3', None,
-                     "run 2to3 on 3.x installs"),
+                     "convert the package with 2to3 for 3.x installs"),
                     ('msvc2005', None,
                      "check if msvc 2005 redistributable package is installed"),
                     ('msvc2005sp1', None,
@@ -548,11 +1532,127 @@ class bdist_nsi(Command):
                      " and install folder; useful for allowing"
                      " different versions"
                      " of the same package installed simultaneously"),
+                    ('matrix-interpreters=', None,
+                     "comma separated list of python interpreters"
+                     " to build installers with, in parallel"),
+                    ('matrix-build-dir=', None,
+                     "build folder with prebuilt per version"
+                     " build/lib.<plat>-<version> trees"
+                     " to create installers from, in parallel"),
+                    ('matrix-combined', None,
+                     "create a single installer for all versions of the"
+                     " matrix, with a separate payload for each version"),
+                    ('watch', None,
+                     "keep running, and update the installer"
+                     " whenever one of its source files changes"),
+                    ('watch-interval=', None,
+                     "seconds between checks for changes in watch mode"
+                     " (default: 1)"),
+                    ('fast-size', None,
+                     "estimate the installed size instead of compiling"
+                     " the package to measure it"),
+                    ('cache-dir=', None,
+                     "directory for caching bytecode between builds,"
+                     " which can be shared between projects"
+                     " (default: $BDIST_NSI_CACHE_DIR, if set)"),
+                    ('cache-size=', None,
+                     "maximum size of the cache in megabytes"
+                     " (default: 256)"),
+                    ('reproducible', None,
+                     "create the same script and installer for the same"
+                     " inputs: no absolute paths, and all file times set"
+                     " to $SOURCE_DATE_EPOCH (default: 1980-01-01)"),
+                    ('store-incompressible', None,
+                     "store already compressed files (by extension or"
+                     " content) without compression; this disables solid"
+                     " compression if there are any such files"),
+                    ('include=', None,
+                     "only install the files matching one of these"
+                     " (comma or space separated) patterns, relative to"
+                     " site-packages, Scripts, or Include"),
+                    ('exclude=', None,
+                     "do not install the files matching one of these"
+                     " (comma or space separated) patterns, relative to"
+                     " site-packages, Scripts, or Include"),
+                    ('zip-packages', None,
+                     "install the packages and modules which do not need"
+                     " loose files as a single zip file"),
+                    ('zip-bytecode', None,
+                     "put bytecode instead of source into the zip file"
+                     " (only if the target is the running python version)"),
+                    ('install-timing', None,
+                     "make the installer log the time taken by each of its"
+                     " phases, to ${PRODUCT_NAME}-timing.log in its"
+                     " install folder (see timing-report)"),
+                    ('timing-report=', None,
+                     "print a report on the given comma separated timing"
+                     " logs (wildcards allowed) of install-timing"
+                     " installers, instead of building one"),
+                    ('from-wheel=', None,
+                     "create the installer from this wheel, instead of"
+                     " building and installing the distribution"),
+                    ('languages=', None,
+                     "comma separated languages of the installer, or auto"
+                     " for the language of the build machine, or none for"
+                     " English only (default: all)"),
+                    ('minify-script', None,
+                     "strip comments, blank lines, and indentation from"
+                     " the generated script"),
+                    ('no-validate-script', None,
+                     "do not check the generated script for errors"
+                     " before running makensis"),
+                    ('analyze-script=', None,
+                     "write a JSON report on the size of each part of the"
+                     " generated script to this file (- for stdout)"),
+                    ('base-manifest=', None,
+                     "manifest of an earlier release; creates a patch"
+                     " installer which only ships the files changed"
+                     " since that release"),
+                    ('bits=', None,
+                     "32 or 64 to only support 32 or 64 bit targets, or"
+                     " both (default: both)"),
+                    ('split-bits', None,
+                     "with both bits, create separate 32 and 64 bit"
+                     " installers, in parallel"),
+                    ('upgrade', None,
+                     "make upgrades only overwrite the files which changed,"
+                     " and only clean the files which are no longer"
+                     " shipped, for the earlier releases with an installer"
+                     " and manifest in dist-dir (see upgrade-from)"),
+                    ('upgrade-from=', None,
+                     "comma separated manifests of earlier releases, to"
+                     " use instead of those in dist-dir (implies"
+                     " --upgrade)"),
+                    ('components', None,
+                     "make each target a group of sections, one for the"
+                     " required packages and one for each other package"
+                     " or module in site-packages, which can be left out"),
+                    ('component-groups=', None,
+                     "semicolon separated name=patterns groups of packages"
+                     " and modules which share one section, for instance"
+                     " Examples=foo_examples,foo_data (implies"
+                     " --components)"),
+                    ('required-components=', None,
+                     "comma separated sections which are always installed"
+                     " (default: the packages and modules of the"
+                     " distribution; implies --components)"),
+                    ('progress', None,
+                     "show the progress of each phase of the build, with"
+                     " throughput and estimated time to completion"),
+                    ('progress-hook=', None,
+                     "comma separated functions, as module:function, which"
+                     " are called with a dictionary for every progress"
+                     " event (see bdist_nsi.progress)"),
                     ]
 
     boolean_options = ['keep-temp', 'no-target-compile', 'no-target-optimize',
                        'skip-build', 'run2to3', 'msvc2005', 'msvc2005sp1',
-                       'msvc2008', 'msvc2008sp1', 'maya', 'blender', 'debug']
+                       'msvc2008', 'msvc2008sp1', 'maya', 'blender', 'debug',
+                       'matrix-combined', 'watch', 'fast-size',
+                       'reproducible', 'minify-script', 'no-validate-script',
+                       'store-incompressible', 'zip-packages',
+                       'zip-bytecode', 'install-timing', 'progress',
+                       'upgrade', 'split-bits', 'components']
 
     def initialize_options (self):
         self.bdist_dir = None
@@ -578,6 +1678,40 @@ class bdist_nsi(Command):
         self.blender = 0
         self.debug = 0
         self.productkey = None
+        self.matrix_interpreters = None
+        self.matrix_build_dir = None
+        self.matrix_combined = 0
+        self.watch = 0
+        self.watch_interval = None
+        self.fast_size = 0
+        self.cache_dir = None
+        self.cache_size = None
+        self.base_manifest = None
+        self.reproducible = 0
+        self.analyze_script = None
+        self.minify_script = 0
+        self.no_validate_script = 0
+        self.languages = None
+        self.store_incompressible = 0
+        self.include = None
+        self.exclude = None
+        self.zip_packages = 0
+        self.zip_bytecode = 0
+        self.install_timing = 0
+        self.timing_report = None
+        self.from_wheel = None
+        self.bits = None
+        self.split_bits = 0
+        self.upgrade = 0
+        self.upgrade_from = None
+        self.components = 0
+        self.component_groups = None
+        self.required_components = None
+        self.progress = 0
+        self.progress_hook = None
+        self.installers = {}
+        self.manifests = {}
+        self.nsis_defines = {}
 
     # initialize_options()
 
@@ -591,10 +1725,31 @@ class bdist_nsi(Command):
                 bdist.plat_name = self.plat_name
                 # next the command will be initialized using that name
             bdist_base = self.get_finalized_command('bdist').bdist_base
-            self.bdist_dir = os.path.join(bdist_base, 'nsi')
+            # unique per run, so parallel builds do not share their files
+            self.bdist_dir = os.path.join(bdist_base, get_run_name('nsi-'))
         if not self.target_version:
             self.target_version = ""
-        if not self.skip_build and self.distribution.has_ext_modules():
+        if self.bits in (None, "", "both"):
+            self.bits = None
+        elif self.bits in ("32", "64"):
+            self.bits = int(self.bits)
+        else:
+            raise DistutilsOptionError("bits must be 32, 64, or both")
+        if self.from_wheel:
+            # the wheel is built already, and determines the target
+            target_version, bits = get_wheel_target(self.from_wheel)
+            if self.bits is None:
+                self.bits = bits
+            elif bits is not None and bits != self.bits:
+                raise DistutilsOptionError(
+                    "bits can only be %i for %s" % (bits, self.from_wheel))
+            if not self.target_version:
+                self.target_version = target_version
+            elif target_version and target_version != self.target_version:
+                raise DistutilsOptionError(
+                    "target version can only be %s for %s"
+                    % (target_version, self.from_wheel))
+        elif not self.skip_build and self.distribution.has_ext_modules():
             short_version = get_python_version()
             if self.target_version and self.target_version != short_version:
                 raise DistutilsOptionError("target version can only be %s, or the '--skip_build'" \
@@ -629,19 +1784,100 @@ class bdist_nsi(Command):
                 "with --nsis-dir")
             self.nsis_dir = None
 
+        # native paths, nsis_path converts them for the script
         if not self.headerbitmap:
             self.headerbitmap = os.path.join(os.path.dirname(__file__),
-                                             "python-install-150x57.bmp").replace("/", "\\")
-        else:
-            self.headerbitmap = self.abspath(self.headerbitmap)
+                                             "python-install-150x57.bmp")
+        self.headerbitmap = os.path.abspath(self.headerbitmap)
         if not self.bitmap:
             self.bitmap = os.path.join(os.path.dirname(__file__),
-                                       "python-install-164x314.bmp").replace("/", "\\")
-        else:
-            self.bitmap = self.abspath(self.bitmap)
+                                       "python-install-164x314.bmp")
+        self.bitmap = os.path.abspath(self.bitmap)
 
         if self.nshextra:
-            self.nshextra = self.abspath(self.nshextra)
+            self.nshextra = os.path.abspath(self.nshextra)
+
+        if self.watch and (self.matrix_interpreters or self.matrix_build_dir):
+            raise DistutilsOptionError(
+                "watch mode cannot be combined with a build matrix")
+        if self.from_wheel and (self.watch or self.matrix_interpreters
+                                or self.matrix_build_dir):
+            raise DistutilsOptionError(
+                "an installer from a wheel cannot be combined with"
+                " watch mode or a build matrix")
+        if self.split_bits and self.bits is not None:
+            raise DistutilsOptionError(
+                "split-bits needs installers for both bits")
+        if self.split_bits and (self.watch or self.matrix_build_dir
+                                or self.matrix_combined):
+            raise DistutilsOptionError(
+                "split-bits cannot be combined with watch mode or a build"
+                " matrix other than matrix-interpreters")
+        if self.watch_interval is None:
+            self.watch_interval = 1.0
+        else:
+            try:
+                self.watch_interval = float(self.watch_interval)
+            except ValueError:
+                raise DistutilsOptionError(
+                    "watch-interval must be a number of seconds")
+
+        if self.cache_dir is None:
+            self.cache_dir = os.environ.get('BDIST_NSI_CACHE_DIR')
+        if self.cache_size is None:
+            self.cache_size = 256
+        else:
+            try:
+                self.cache_size = int(self.cache_size)
+            except ValueError:
+                raise DistutilsOptionError(
+                    "cache-size must be an integer number of megabytes")
+
+        self.languages = get_languages(self.languages)
+
+        # file patterns, also from multiple lines in setup.cfg
+        self.include = (self.include or "").replace(",", " ").split()
+        self.exclude = (self.exclude or "").replace(",", " ").split()
+        self.upgrade_from = [
+            manifest.strip()
+            for manifest in (self.upgrade_from or "").split(",")
+            if manifest.strip()]
+        if self.upgrade_from:
+            self.upgrade = 1
+
+        groups = []
+        for group in (self.component_groups or "").split(";"):
+            if not group.strip():
+                continue
+            name, sep, patterns = group.partition("=")
+            if not sep or not name.strip():
+                raise DistutilsOptionError(
+                    "component-groups must be name=patterns groups,"
+                    " separated by ;")
+            groups.append(
+                (name.strip(), patterns.replace(",", " ").split()))
+        self.component_groups = groups
+        if self.required_components is not None:
+            self.components = 1
+            self.required_components = [
+                name.strip() for name in self.required_components.split(",")
+                if name.strip()]
+        else:
+            # the packages and modules of the distribution
+            self.required_components = sorted(set(
+                name.split('.')[0] for name in
+                (self.distribution.packages or [])
+                + (self.distribution.py_modules or [])
+                + [ext.name
+                   for ext in (self.distribution.ext_modules or [])]))
+        if self.component_groups:
+            self.components = 1
+
+        self.progress_hooks = [
+            load_hook(name)
+            for name in (self.progress_hook or "").replace(",", " ").split()]
+        if self.progress:
+            self.progress_hooks.append(ConsoleProgress())
 
         self.set_undefined_options('bdist',
                                    ('dist_dir', 'dist_dir'),
@@ -651,11 +1887,69 @@ class bdist_nsi(Command):
 
     # finalize_options()
 
+    def progress_event(self, event, phase, **info):
+        """Call the progress hooks with a dictionary which holds the
+        event ('start', 'progress', 'end', or 'output' for a line of
+        makensis output), the phase ('build', 'stage', 'scan', 'compile',
+        'emit', or 'makensis'), the time, and info, such as the number of
+        files done and the total.
+        """
+        if not self.progress_hooks:
+            return
+        info.update(event=event, phase=phase, time=time.time())
+        for hook in self.progress_hooks:
+            hook(info)
+
     def abspath(self, filename):
         # absolute path with windows separator
         return os.path.abspath(filename).replace('/', '\\')
 
+    def nsis_path(self, filename, resource=False):
+        # path for the script, relative to the script folder for
+        # reproducible builds, as makensis runs from there; resources
+        # from outside the source tree are copied next to the script
+        if not self.reproducible:
+            return self.abspath(filename)
+        filename = os.path.abspath(filename.replace('\\', '/'))
+        try:
+            outside = os.path.relpath(filename).startswith(os.pardir)
+        except ValueError:
+            # on another drive
+            outside = True
+        if resource and outside:
+            copy_file(filename, self.bdist_dir, dry_run=self.dry_run)
+            return os.path.basename(filename)
+        try:
+            return os.path.relpath(
+                filename, os.path.abspath(self.bdist_dir)).replace('/', '\\')
+        except ValueError:
+            # no relative path to another drive
+            return self.abspath(filename)
+
     def run (self):
+        if self.timing_report:
+            filenames = []
+            for pattern in self.timing_report.split(","):
+                matches = sorted(glob.glob(pattern.strip()))
+                if not matches:
+                    raise DistutilsFileError(
+                        "no timing log matches %s" % pattern.strip())
+                filenames.extend(matches)
+            print(report_install_timing(filenames))
+            return
+
+        if self.matrix_interpreters or self.matrix_build_dir:
+            self.run_matrix()
+            return
+
+        if self.from_wheel:
+            # no build, no install, and no platform restrictions
+            self.compile(self.build_nsi_per_bits(
+                lambda root: self.stage_wheel(self.from_wheel, root)))
+            if not self.keep_temp:
+                remove_tree(self.bdist_dir, dry_run=self.dry_run)
+            return
+
         if (sys.platform != "win32" and
             (self.distribution.has_ext_modules() or
              self.distribution.has_c_libraries())):
@@ -664,19 +1958,11 @@ class bdist_nsi(Command):
                    "must be compiled on a Windows 32 platform")
 
         if not self.skip_build:
+            self.progress_event('start', 'build')
             self.run_command('build')
+            self.progress_event('end', 'build')
 
-        install = self.reinitialize_command('install', reinit_subcommands=1)
-        install.root = self.bdist_dir
-        install.skip_build = self.skip_build
-        install.warn_dir = 0
-        install.plat_name = self.plat_name
-
-        install_lib = self.reinitialize_command('install_lib')
-        # we do not want to include pyc or pyo files
-        install_lib.compile = 0
-        install_lib.optimize = 0
-
+        build_lib = None
         if self.distribution.has_ext_modules():
             # If we are building an installer for a Python version other
             # than the one we are currently running, then we need to ensure
@@ -690,44 +1976,513 @@ class bdist_nsi(Command):
                 target_version = sys.version[0:3]
             plat_specifier = ".%s-%s" % (self.plat_name, target_version)
             build = self.get_finalized_command('build')
-            build.build_lib = os.path.join(build.build_base,
-                                           'lib' + plat_specifier)
+            build_lib = os.path.join(build.build_base,
+                                     'lib' + plat_specifier)
+
+        nsifile = self.build_nsi_per_bits(
+            lambda root: self.stage(root, build_lib=build_lib))
+        self.compile(nsifile)
+
+        if self.watch:
+            self.watch_sources(nsifile, build_lib)
+        
+        if not self.keep_temp:
+            remove_tree(self.bdist_dir, dry_run=self.dry_run)
+
+    def build_nsi_per_bits(self, stage):
+        """Stage into the staging folder with stage(root), and build the
+        script. With split-bits, do so for 32 and for 64 bits, each in its
+        own folder, and return both scripts, to compile in parallel.
+        The files are only staged once, and copied for 64 bits, and the
+        bytecode is only compiled once, through the cache.
+        """
+        if not self.split_bits:
+            stage(self.bdist_dir)
+            return self.build_nsi()
+        bdist_dir = self.bdist_dir
+        cache_dir = self.cache_dir
+        if not cache_dir:
+            self.cache_dir = os.path.join(bdist_dir, 'cache')
+        stage(os.path.join(bdist_dir, '32'))
+        if self.dry_run:
+            # nothing was staged to copy
+            stage(os.path.join(bdist_dir, '64'))
+        else:
+            # copied before build_nsi changes the staged files, and not
+            # linked, as 2to3 converts them in place
+            copy_tree(os.path.join(bdist_dir, '32'),
+                      os.path.join(bdist_dir, '64'), verbose=0)
+        nsifiles = []
+        for bits in (32, 64):
+            self.bdist_dir = os.path.join(bdist_dir, str(bits))
+            self.bits = bits
+            nsifiles.append(self.build_nsi())
+        self.bdist_dir = bdist_dir
+        self.bits = None
+        self.cache_dir = cache_dir
+        return nsifiles
+
+    def stage_wheel(self, wheel, root, py_dirname='_python'):
+        """Extract the files listed in the RECORD of the wheel into root,
+        in the same layout as stage, checking their hashes on the way.
+        """
+        log.info("extracting %s to %s", wheel, root)
+        if self.dry_run:
+            return
+        wheelfile = zipfile.ZipFile(wheel)
+        names = wheelfile.namelist()
+        record = [name for name in names
+                  if re.match(r'^[^/]+\.dist-info/RECORD$', name)]
+        if len(record) != 1:
+            raise DistutilsFileError("%s has no RECORD" % wheel)
+        data_dir = record[0].split('.dist-info/')[0] + '.data/'
+        dist_name = data_dir.split('-')[0]
+        lines = wheelfile.read(record[0])
+        if sys.version_info[0] >= 3:
+            lines = lines.decode('utf-8')
+        rows = list(csv.reader(lines.splitlines()))
+        self.progress_event('start', 'stage', payload=py_dirname,
+                            total=len(rows))
+        for i, fields in enumerate(rows):
+            self.progress_event('progress', 'stage', payload=py_dirname,
+                                done=i, total=len(rows))
+            if len(fields) != 3 or fields[0].endswith('/'):
+                continue
+            name, digest = fields[:2]
+            if (name.startswith('/') or ':' in name.split('/')[0]
+                    or '\\' in name or '..' in name.split('/')):
+                raise DistutilsFileError(
+                    "%s in %s is not a relative path inside the wheel"
+                    % (name, wheel))
+            # map the install schemes onto the staging folders
+            if name.startswith(data_dir):
+                scheme, path = name[len(data_dir):].split('/', 1)
+                folder = {'purelib': 'Lib/site-packages',
+                          'platlib': 'Lib/site-packages',
+                          'scripts': 'Scripts',
+                          'headers': 'Include/%s' % dist_name}.get(scheme)
+                if folder is None:
+                    log.warn("warning: ignoring %s", name)
+                    continue
+            else:
+                folder, path = 'Lib/site-packages', name
+            target = os.path.join(root, py_dirname,
+                                  *(folder + '/' + path).split('/'))
+            self.mkpath(os.path.dirname(target))
+            # stream the file out of the wheel
+            if digest:
+                algorithm, expected = digest.split('=', 1)
+                checksum = hashlib.new(algorithm)
+            source = wheelfile.open(name)
+            stream = open(target, 'wb')
+            for chunk in iter(lambda: source.read(65536), b''):
+                if digest:
+                    checksum.update(chunk)
+                stream.write(chunk)
+            stream.close()
+            source.close()
+            if digest and base64.urlsafe_b64encode(
+                    checksum.digest()).decode('ascii').rstrip('=') != expected:
+                raise DistutilsFileError(
+                    "%s in %s does not match its RECORD" % (name, wheel))
+        wheelfile.close()
+        self.progress_event('end', 'stage', payload=py_dirname,
+                            done=len(rows))
+
+    def stage(self, root, py_dirname='_python', build_lib=None,
+              build_scripts=None):
+        """Install the distribution into root, using the windows
+        installation scheme with py_dirname as base. If build_lib or
+        build_scripts are given, then they are installed instead of the
+        build tree of the running interpreter.
+        """
+        install = self.reinitialize_command('install', reinit_subcommands=1)
+        install.root = root
+        install.skip_build = self.skip_build
+        install.warn_dir = 0
+        install.plat_name = self.plat_name
+
+        install_lib = self.reinitialize_command('install_lib')
+        # we do not want to include pyc or pyo files
+        install_lib.compile = 0
+        install_lib.optimize = 0
+
+        if build_lib is not None or build_scripts is not None:
+            build = self.get_finalized_command('build')
+            if build_lib is not None:
+                build.build_lib = build_lib
+            if build_scripts is not None:
+                build.build_scripts = build_scripts
         # use windows installation scheme
         for key in WINDOWS_SCHEME.keys():
-            value = WINDOWS_SCHEME[key].replace("$base", "_python")
+            value = WINDOWS_SCHEME[key].replace("$base", py_dirname)
             setattr(install,
                     'install_' + key,
                     value)
 
-        log.info("installing to %s", self.bdist_dir)
+        log.info("installing to %s", root)
         install.ensure_finalized()
+        sub_commands = install.get_sub_commands()
+        self.progress_event('start', 'stage', payload=py_dirname)
+        # report the files of each install command once it is done; the
+        # total is not known before, as install_data only knows its
+        # files once it ran
+        done = [0]
+        def run_command(command):
+            Command.run_command(install, command)
+            if command in sub_commands:
+                done[0] += len(
+                    install.get_finalized_command(command).get_outputs())
+                self.progress_event('progress', 'stage', payload=py_dirname,
+                                    done=done[0])
+        install.run_command = run_command
         install.run()
+        self.progress_event('end', 'stage', payload=py_dirname,
+                            done=len(install.get_outputs()))
+
+    def get_resource_dependencies(self):
+        """Bitmaps and icons of the installer, which reproducible builds
+        copy next to the script if they are outside the source tree.
+        """
+        paths = [self.bitmap, self.headerbitmap,
+                 os.path.join(os.path.dirname(__file__), "python-install.ico"),
+                 os.path.join(os.path.dirname(__file__), "python-uninstall.ico")]
+        return set(os.path.abspath(path.replace("\\", os.sep))
+                   for path in paths)
+
+    def get_script_dependencies(self):
+        """Files which are only read by makensis, so when they change it
+        suffices to rerun makensis.
+        """
+        paths = self.get_resource_dependencies()
+        if self.nshextra:
+            paths.add(os.path.abspath(self.nshextra))
+        return paths
+
+    def remove_bytecode(self):
+        """Remove the bytecode which build_nsi compiled into the staging
+        trees, so that restaging does not ship it.
+        """
+        if not os.path.isdir(self.bdist_dir):
+            return
+        for name in os.listdir(self.bdist_dir):
+            if not name.startswith('_python'):
+                continue
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.bdist_dir, name)):
+                if '__pycache__' in dirnames:
+                    dirnames.remove('__pycache__')
+                    remove_tree(os.path.join(dirpath, '__pycache__'),
+                                dry_run=self.dry_run)
+                for filename in filenames:
+                    if filename.endswith(('.pyc', '.pyo')) and not self.dry_run:
+                        os.remove(os.path.join(dirpath, filename))
+
+    def get_source_dependencies(self):
+        """Files from which the staging tree is built."""
+        paths = set(os.path.abspath(path) for path in [
+            'license', 'license.txt', 'license.rst',
+            'LICENSE', 'LICENSE.txt', 'LICENSE.rst',
+            'LICENSE.TXT', 'LICENSE.RST'])
+        if self.distribution.has_pure_modules():
+            build_py = self.get_finalized_command('build_py')
+            paths.update(build_py.get_source_files())
+            # also picks up new modules and package data
+            for package in self.distribution.packages or []:
+                package_dir = build_py.get_package_dir(package)
+                if os.path.isdir(package_dir):
+                    paths.update(os.path.join(package_dir, name)
+                                 for name in os.listdir(package_dir))
+        paths.update(self.distribution.scripts or [])
+        for ext in self.distribution.ext_modules or []:
+            paths.update(ext.sources)
+            paths.update(ext.depends or [])
+        for data in self.distribution.data_files or []:
+            if isinstance(data, str):
+                paths.add(data)
+            else:
+                paths.update(data[1])
+        return set(os.path.abspath(path) for path in paths
+                   if not os.path.isdir(path))
+
+    def get_watch_snapshot(self):
+        """Modification time (or None, if missing) of all watched files."""
+        snapshot = {}
+        for path in (self.get_source_dependencies()
+                     | self.get_script_dependencies()):
+            try:
+                snapshot[path] = os.stat(path).st_mtime
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def watch_sources(self, nsifile, build_lib=None):
+        """Rebuild the installer whenever a watched file changes, until
+        interrupted. Only the stages affected by the change are rerun:
+        if only files used by makensis changed, then only makensis is
+        rerun, otherwise the changed files are restaged first.
+        """
+        log.info("watching for changes (press Ctrl+C to stop)")
+        snapshot = self.get_watch_snapshot()
+        try:
+            while True:
+                time.sleep(self.watch_interval)
+                new_snapshot = self.get_watch_snapshot()
+                if new_snapshot == snapshot:
+                    continue
+                # wait until files stop changing
+                while True:
+                    time.sleep(self.watch_interval)
+                    newer_snapshot = self.get_watch_snapshot()
+                    if newer_snapshot == new_snapshot:
+                        break
+                    new_snapshot = newer_snapshot
+                changed = set(
+                    path for path in set(snapshot) | set(new_snapshot)
+                    if snapshot.get(path) != new_snapshot.get(path))
+                snapshot = new_snapshot
+                start = time.time()
+                sources = changed - self.get_script_dependencies()
+                for path in sorted(changed):
+                    log.info("changed: %s", path)
+                if sources:
+                    if any(not os.path.exists(path) for path in sources):
+                        # removed files must also be removed from the build
+                        # and staging trees, so start these from scratch
+                        build = self.get_finalized_command('build')
+                        for tree in [build.build_lib, build.build_scripts,
+                                     os.path.join(self.bdist_dir, '_python')]:
+                            if os.path.isdir(tree) and (
+                                    tree.startswith(self.bdist_dir)
+                                    or not self.skip_build):
+                                remove_tree(tree, dry_run=self.dry_run)
+                    if not self.skip_build:
+                        self.reinitialize_command(
+                            'build', reinit_subcommands=1)
+                        self.run_command('build')
+                    self.remove_bytecode()
+                    self.stage(self.bdist_dir, build_lib=build_lib)
+                    nsifile = self.build_nsi()
+                elif self.reproducible:
+                    # the script refers to copies of these
+                    for path in changed & self.get_resource_dependencies():
+                        if os.path.exists(path):
+                            self.nsis_path(path, resource=True)
+                self.compile(nsifile)
+                log.info("installer updated in %.1f seconds",
+                         time.time() - start)
+        except KeyboardInterrupt:
+            log.info("stopped watching")
+
+    def run_matrix(self):
+        """Build installers for several python versions in parallel,
+        either with the given interpreters, or from the per version
+        build trees in the given build folder.
+        """
+        build_base = self.matrix_build_dir
+        if self.matrix_interpreters:
+            interpreters = [interpreter.strip() for interpreter
+                            in self.matrix_interpreters.split(",")]
+            setup_args = [self.distribution.script_name]
+            if self.distribution.command_packages:
+                command_packages = self.distribution.command_packages
+                if not isinstance(command_packages, str):
+                    command_packages = ",".join(
+                        package for package in command_packages
+                        if package != 'distutils.command')
+                setup_args += ['--command-packages', command_packages]
+            # the build options of the command line apply to all
+            build_options = []
+            for command in self.BUILD_COMMANDS:
+                options = self.get_command_line_options(command)
+                if command == 'build':
+                    build_options = options
+                elif options:
+                    setup_args += [command] + options
+            # every interpreter builds into its own trees, also for pure
+            # distributions, which would otherwise share build/lib
+            build_base = self.get_finalized_command('build').build_base
+            versions = {}
+            commands = []
+            for i, interpreter in enumerate(interpreters):
+                version = get_interpreter_version(interpreter)
+                if version in versions:
+                    raise DistutilsOptionError(
+                        "%s and %s are both python %s, so their builds"
+                        " and installers would have the same name"
+                        % (versions[version], interpreter, version))
+                versions[version] = interpreter
+                plat_specifier = ".%s-%s" % (self.plat_name, version)
+                args = [interpreter] + setup_args + ['build'] + build_options + [
+                    '--build-lib=%s' % os.path.join(
+                        build_base, 'lib' + plat_specifier),
+                    '--build-temp=%s' % os.path.join(
+                        build_base, 'temp' + plat_specifier),
+                    '--build-scripts=%s' % os.path.join(
+                        build_base, 'scripts-' + version)]
+                if self.matrix_combined:
+                    # every interpreter builds, we install and package
+                    commands.append(args)
+                else:
+                    # every interpreter creates its own installer, for
+                    # its own version, so the installer names differ
+                    commands.append(
+                        args + ['bdist_nsi']
+                        + self.get_matrix_options(
+                            os.path.join(self.bdist_dir, 'matrix%i' % i))
+                        + ['--target-version=%s' % version])
+            failed = run_parallel(commands, dry_run=self.dry_run)
+            if (not self.matrix_combined and not self.keep_temp
+                    and os.path.isdir(self.bdist_dir)):
+                remove_tree(self.bdist_dir, dry_run=self.dry_run)
+            if failed:
+                raise DistutilsExecError(
+                    "building with one or more interpreters failed")
+            if not self.matrix_combined:
+                return
+        if os.path.isdir(build_base):
+            build_trees = find_build_trees(build_base, self.plat_name)
+        else:
+            build_trees = {}
+        if not build_trees:
+            raise DistutilsOptionError(
+                "no per version build trees found in %s" % build_base)
+        versions = sorted(build_trees)
+        # scripts are usually version independent, so use those of
+        # another version if a version has none
+        default_build_scripts = self.get_finalized_command(
+            'build').build_scripts
+        for version in versions:
+            if build_trees[version][1] is not None:
+                default_build_scripts = build_trees[version][1]
+        for version in versions:
+            build_lib, build_scripts = build_trees[version]
+            build_trees[version] = (
+                build_lib, build_scripts or default_build_scripts)
+        if self.matrix_combined:
+            payloads = []
+            for version in versions:
+                py_dirname = '_python' + version.replace('.', '')
+                build_lib, build_scripts = build_trees[version]
+                self.stage(self.bdist_dir, py_dirname,
+                           build_lib, build_scripts)
+                payloads.append((py_dirname, version))
+            self.target_version = ""
+            self.target_versions = ",".join(versions)
+            nsifiles = [self.build_nsi(payloads)]
+        else:
+            bdist_dir = self.bdist_dir
+            nsifiles = []
+            for version in versions:
+                self.bdist_dir = os.path.join(bdist_dir, version)
+                self.target_version = version
+                build_lib, build_scripts = build_trees[version]
+                self.stage(self.bdist_dir, '_python',
+                           build_lib, build_scripts)
+                nsifiles.append(self.build_nsi())
+            self.bdist_dir = bdist_dir
+        self.compile(nsifiles)
 
-        self.build_nsi()
-        
         if not self.keep_temp:
             remove_tree(self.bdist_dir, dry_run=self.dry_run)
 
+    # commands whose command line options are passed on to the matrix
+    BUILD_COMMANDS = ('build', 'build_py', 'build_ext', 'build_clib',
+                      'build_scripts')
+
+    def get_command_line_options(self, command, skip=()):
+        """Options given to command on the command line, except those in
+        skip, as arguments for setup.py.
+        """
+        options = []
+        command_class = self.distribution.get_command_class(command)
+        boolean_options = getattr(command_class, 'boolean_options', [])
+        negative_options = dict(
+            (option, negative) for negative, option
+            in getattr(command_class, 'negative_opt', {}).items())
+        for name, (source, value) in sorted(
+                self.distribution.get_option_dict(command).items()):
+            # other sources are also read by the other interpreter
+            if source != "command line" or name in skip:
+                continue
+            option = name.replace('_', '-')
+            if option in boolean_options or option in negative_options:
+                if value:
+                    options.append('--%s' % option)
+                elif option in negative_options:
+                    options.append('--%s' % negative_options[option])
+            else:
+                options.append('--%s=%s' % (option, value))
+        return options
+
+    def get_matrix_options(self, bdist_dir):
+        """Command line options to pass to bdist_nsi when it is run for
+        another interpreter.
+        """
+        return ['--bdist-dir=%s' % os.path.abspath(bdist_dir)] + (
+            self.get_command_line_options(
+                'bdist_nsi',
+                skip=('bdist_dir', 'target_version', 'matrix_interpreters',
+                      'matrix_build_dir', 'matrix_combined')))
+
     # run()
 
     
-    def build_nsi(self):
+    def build_nsi(self, payloads=None):
+        """Write setup.nsi for the payloads staged in bdist_dir. With
+        the reproducible option, the same staged files give the same
+        script, byte for byte, and the script has no absolute paths.
+
+        >>> from distutils.dist import Distribution
+        >>> import shutil
+        >>> tmp = tempfile.mkdtemp()
+        >>> open(os.path.join(tmp, 'makensis'), 'w').close()
+        >>> os.chmod(os.path.join(tmp, 'makensis'), 493)
+        >>> cmd = bdist_nsi(Distribution({'name': 'foo', 'version': '1.0'}))
+        >>> cmd.bdist_dir = cmd.dist_dir = cmd.nsis_dir = tmp
+        >>> cmd.reproducible = 1
+        >>> cmd.no_target_compile = cmd.no_target_optimize = 1
+        >>> cmd.ensure_finalized()
+        >>> def render(mtime):
+        ...     cmd.bdist_dir = tempfile.mkdtemp()
+        ...     package = os.path.join(
+        ...         cmd.bdist_dir, '_python', 'Lib', 'site-packages', 'foo')
+        ...     os.makedirs(package)
+        ...     for name in ['__init__.py', 'bar.py', 'baz.py']:
+        ...         open(os.path.join(package, name), 'w').close()
+        ...         os.utime(os.path.join(package, name), (mtime, mtime))
+        ...     cmd.build_nsi()
+        ...     nsifile = open(os.path.join(cmd.bdist_dir, 'setup.nsi'), 'rb')
+        ...     nsiscript = nsifile.read()
+        ...     nsifile.close()
+        ...     assert cmd.bdist_dir.encode("utf-8") not in nsiscript
+        ...     remove_tree(cmd.bdist_dir)
+        ...     return nsiscript
+        >>> render(1000000000) == render(1500000000)
+        True
+        >>> remove_tree(tmp)
+        """
         if self.target_version.upper() not in ["","ANY"]:
-            nsiscript = get_nsi(target_versions=[self.target_version])
+            target_versions = [self.target_version]
         elif self.target_versions:
-            nsiscript = get_nsi(target_versions=self.target_versions.split(","))
+            target_versions = self.target_versions.split(",")
         elif sys.version_info[0] < 3:
             # python 2.x
             target_versions = ["2.3", "2.4", "2.5", "2.6", "2.7"]
             if self.run2to3:
                 target_versions.extend(["3.0", "3.1", "3.2", "3.3", "3.4"])
-            nsiscript = get_nsi(target_versions=target_versions)
         else:
             # python 3.x
             target_versions = ["3.0", "3.1", "3.2", "3.3", "3.4"]
             # disable 2to3
             self.run2to3 = 0
-            nsiscript = get_nsi(target_versions=target_versions)
+        # only generate the script for the enabled features
+        features = [feature for feature in FEATURES
+                    if getattr(self, feature)]
+        nsiscript = get_nsi(target_versions=target_versions,
+                            bits=self.bits,
+                            features=features,
+                            languages=self.languages)
         metadata = self.distribution.metadata
 
         def get_full_author(key):
@@ -778,16 +2533,63 @@ class bdist_nsi(Command):
             if os.path.exists(licensefile):
                 nsiscript=nsiscript.replace('@haslicensefile@', "")
                 nsiscript=nsiscript.replace('@licensefile@',
-                                            self.abspath(licensefile))
+                                            self.nsis_path(licensefile))
                 break
         else:
             nsiscript=nsiscript.replace('@haslicensefile@', ";")
 
+        if self.base_manifest:
+            manifest_file = open(self.base_manifest, 'rt')
+            base_manifest = json.load(manifest_file)
+            manifest_file.close()
+            base_files = base_manifest['files']
+            fullname = "%s-patch-from-%s" % (
+                self.distribution.get_fullname(), base_manifest['version'])
+            nsiscript=nsiscript.replace('@hasbaseversion@', "")
+            nsiscript=nsiscript.replace('@baseversion@',
+                                        base_manifest['version'])
+        else:
+            base_files = None
+            fullname = self.distribution.get_fullname()
+            nsiscript=nsiscript.replace('@hasbaseversion@', ";")
+
+        # win32 also for installers for both bits, as before
+        plat = "win-amd64" if self.bits == 64 else "win32"
         if self.target_version:
-            installer_path = os.path.join(self.dist_dir, "%s.win32-py%s.exe" % (self.distribution.get_fullname(), self.target_version))
+            installer_path = os.path.join(self.dist_dir, "%s.%s-py%s.exe" % (fullname, plat, self.target_version))
         else:
-            installer_path = os.path.join(self.dist_dir, "%s.win32.exe" % self.distribution.get_fullname())
-        installer_path = self.abspath(installer_path)
+            installer_path = os.path.join(self.dist_dir, "%s.%s.exe" % (fullname, plat))
+
+        upgrade_manifests = []
+        for upgrade_from in self.upgrade_from:
+            manifest_file = open(upgrade_from, 'rt')
+            upgrade_manifests.append(json.load(manifest_file))
+            manifest_file.close()
+        if self.upgrade and not upgrade_manifests:
+            # the manifests of earlier builds of the same kind
+            manifests = find_manifests(
+                self.dist_dir, self.distribution.get_name(),
+                os.path.splitext(installer_path)[0][len(
+                    os.path.join(self.dist_dir, fullname)):])
+            manifests.pop(self.distribution.get_version(), None)
+            if manifests:
+                log.info("upgrades from %s only clean removed files",
+                         ", ".join(sorted(manifests)))
+            else:
+                log.warn("warning: no manifests of earlier releases in %s,"
+                         " upgrades clean all files (see upgrade-from)",
+                         self.dist_dir)
+            upgrade_manifests = [manifests[version]
+                                 for version in sorted(manifests)]
+        manifest_path = os.path.splitext(installer_path)[0] + ".manifest.json"
+        manifest_staged = os.path.join(self.bdist_dir, 'manifest.json')
+        # compile publishes the installer here once makensis succeeds,
+        # followed by the manifest
+        self.installers[os.path.join(self.bdist_dir, 'setup.nsi')] = (
+            os.path.abspath(installer_path))
+        self.manifests[os.path.abspath(installer_path)] = (
+            manifest_staged, os.path.abspath(manifest_path))
+        installer_path = self.nsis_path(installer_path)
                 
         nsiscript=nsiscript.replace('@installer_path@',installer_path)
         
@@ -798,10 +2600,319 @@ class bdist_nsi(Command):
             
         nsiscript=nsiscript.replace('@haspythonversion@',haspythonversion)
         
-        files=[]
+        if self.cache_dir:
+            cache = BuildCache(os.path.join(self.cache_dir, 'bytecode'),
+                               max_size=self.cache_size * 1024 * 1024)
+        else:
+            cache = None
 
-        for dirpath, dirnames, filenames in os.walk(self.bdist_dir+os.sep+'_python'):
-            self.visit(files, dirpath, filenames)
+        if payloads is None:
+            self.filter_payload('_python')
+            payloads = [('_python', None)]
+            if self.run2to3:
+                # 3.x targets get a converted copy of the package
+                self.convert_2to3('_python', '_python3')
+                payloads = [('_python', '2'), ('_python3', '3')]
+        else:
+            for py_dirname, version in payloads:
+                self.filter_payload(py_dirname)
+                if self.run2to3 and version.startswith('3'):
+                    self.convert_2to3(py_dirname, py_dirname)
+        if self.zip_packages:
+            for py_dirname, version in payloads:
+                self.zip_payload(py_dirname, version or self.target_version)
+        if self.reproducible:
+            epoch = get_source_date_epoch()
+        else:
+            epoch = None
+        if self.components:
+            # the same components for all payloads
+            roots = set()
+            for py_dirname, version in payloads:
+                site_packages = os.path.join(
+                    self.bdist_dir, py_dirname, 'Lib', 'site-packages')
+                if os.path.isdir(site_packages):
+                    roots.update(os.listdir(site_packages))
+            components = get_components(
+                roots, self.required_components, self.component_groups)[1]
+            component_indices = dict(
+                (root, index)
+                for index, (name, component_roots)
+                in enumerate(components, 1)
+                for root in component_roots)
+        else:
+            components = []
+            component_indices = None
+        component_sizes = [0] * len(components)
+        _f = []
+        _d = []
+        _c = []
+        pysize = 0
+        manifest_files = {}
+        for py_dirname, version in payloads:
+            abs_py_dir = os.path.abspath(
+                os.path.join(self.bdist_dir, py_dirname))
+            files = scan_files(abs_py_dir, epoch)
+            if version is None:
+                suffix = ''
+            else:
+                suffix = '_' + version.replace('.', '_')
+            # record the release manifest, and compare with the base
+            payload_files = {}
+            self.progress_event('start', 'scan', payload=py_dirname,
+                                total=len(files))
+            for i, each in enumerate(files):
+                if not each[1].endswith(".egg-info"):
+                    path = os.path.join(abs_py_dir, *each[1].split("\\"))
+                    payload_files[each[1]] = file_sha1(path)
+                    manifest_files[py_dirname + "\\" + each[1]] = (
+                        payload_files[each[1]])
+                    if self.upgrade:
+                        # unchanged files keep their time, so upgrades
+                        # can skip them
+                        mtime = get_content_time(payload_files[each[1]])
+                        os.utime(path, (mtime, mtime))
+                self.progress_event('progress', 'scan', payload=py_dirname,
+                                    done=i + 1, total=len(files))
+            self.progress_event('end', 'scan', payload=py_dirname,
+                                done=len(files))
+            if base_files is None:
+                unchanged = None
+            else:
+                unchanged = set(
+                    path for path, sha1 in payload_files.items()
+                    if base_files.get(py_dirname + "\\" + path) == sha1)
+            self.progress_event('start', 'emit', payload=py_dirname,
+                                total=len(files))
+            root_sizes = {}
+            _f_payload, _d_payload, payload_size = self.get_file_commands(
+                files, py_dirname, suffix, cache, unchanged,
+                component_indices, root_sizes)
+            self.progress_event('end', 'emit', payload=py_dirname,
+                                done=len(files))
+            prefix = py_dirname + "\\"
+            def get_removed(earlier_files):
+                return sorted(
+                    key[len(prefix):] for key in earlier_files
+                    if key.startswith(prefix)
+                    and key[len(prefix):] not in payload_files)
+            if base_files is None:
+                # upgrades from known releases only clean removed files,
+                # and reinstalls of this release none
+                _c_payload = []
+                if upgrade_manifests:
+                    _c_payload.append(
+                        '  StrCmp $PREVIOUS_INSTALL "%s" end_clean%s 0\n'
+                        % (self.distribution.get_version(), suffix))
+                for i, manifest in enumerate(upgrade_manifests):
+                    tag = 'upgrade%i%s' % (i, suffix)
+                    _c_payload.append(
+                        '  StrCmp $PREVIOUS_INSTALL "%s" 0 end_%s\n'
+                        % (manifest['version'], tag))
+                    _c_payload += self.get_removed_commands(
+                        get_removed(manifest['files']), '_%i%s' % (i, suffix))
+                    _c_payload.append('  Goto end_clean%s\n' % suffix)
+                    _c_payload.append('end_%s:\n' % tag)
+                _c_payload += _d_payload
+                if upgrade_manifests:
+                    _c_payload.append('end_clean%s:\n\n' % suffix)
+            else:
+                _c_payload = self.get_removed_commands(
+                    get_removed(base_files), suffix)
+            if version is not None:
+                # only install the payload which matches the python version
+                _f_payload = wrap_payload(
+                    _f_payload, version, 'payload' + suffix)
+                _d_payload = wrap_payload(
+                    _d_payload, version, 'clean_payload' + suffix)
+                _c_payload = wrap_payload(
+                    _c_payload, version, 'clean_payload' + suffix)
+            _f += _f_payload
+            _d += _d_payload
+            _c += _c_payload
+
+            if not self.fast_size:
+                # compile folder - for size calculation below
+                optimizes = [optimize for optimize, skip
+                             in [(0, self.no_target_compile),
+                                 (2, self.no_target_optimize)] if not skip]
+                total = len(optimizes) * len(
+                    [each for each in files if each[1].endswith('.py')])
+                self.progress_event('start', 'compile', payload=py_dirname,
+                                    total=total)
+                done = 0
+                for optimize in optimizes:
+                    done = self.compile_bytecode(
+                        abs_py_dir, optimize=optimize, cache=cache,
+                        payload=py_dirname, done=done, total=total)
+                self.progress_event('end', 'compile', payload=py_dirname,
+                                    done=done)
+                payload_size = get_tree_size(abs_py_dir)
+                site_packages = os.path.join(abs_py_dir, 'Lib', 'site-packages')
+                for root in component_indices or ():
+                    if os.path.exists(os.path.join(site_packages, root)):
+                        root_sizes[root] = get_tree_size(
+                            os.path.join(site_packages, root))
+            # each target only gets one payload
+            for index, (name, component_roots) in enumerate(components):
+                size = sum(root_sizes.get(root, 0)
+                           for root in component_roots)
+                payload_size -= size
+                component_sizes[index] = max(component_sizes[index], size)
+            pysize = max(pysize, payload_size)
+
+        if cache is not None:
+            cache.prune()
+
+        if self.upgrade:
+            # files are skipped if their time, and so content, is the same
+            _f.insert(0, '  SetOverwrite ifdiff\n')
+            _f.append('  SetOverwrite on\n')
+
+        # fresh installs have nothing to clean
+        _c.insert(0, '  StrCmp $PREVIOUS_INSTALL "" end_clean_previous 0\n')
+        _c.append('end_clean_previous:\n\n')
+        for _x in (_d, _c):
+            _x.append('  ; remove clutter\n')
+            _x.append('  StrCmp $0 "" end_clean_clutter 0\n')
+            _x.append('  Delete "$0\\Remove${PRODUCT_NAME}.*"\n')
+            _x.append('  Delete "$0\\${PRODUCT_NAME}-wininst.log"\n')
+            _x.append('end_clean_clutter:\n\n')
+
+        # file lists, with how often each is used, for analyze_script
+        regions = {}
+        for name, _x in (('_files', _f), ('_cleanfiles', _c),
+                         ('_deletefiles', _d)):
+            regions[name] = (''.join(_x), nsiscript.count('@%s@' % name))
+            nsiscript=nsiscript.replace('@%s@' % name, regions[name][0])
+
+        if any(line == '  SetCompress off\n' for line in _f):
+            nsiscript=nsiscript.replace('@solid@', '')
+        else:
+            nsiscript=nsiscript.replace('@solid@', '/SOLID ')
+
+        nsiscript=nsiscript.replace('@pysizekb@', str(1 + (pysize // 1000)))
+
+        if self.components:
+            nsiscript=nsiscript.replace('@components@', "".join(
+                ['Var COMPONENT_%i\n' % index
+                   for index in range(1, len(components) + 1)]
+                + ['\n!macro FOR_EACH_COMPONENT macro label\n']
+                + ['    !insertmacro ${macro} ${label} %i "%s" %i\n'
+                   % (index, name, 1 + (size // 1000))
+                   for index, ((name, component_roots), size)
+                   in enumerate(zip(components, component_sizes), 1)]
+                + ['!macroend\n']))
+        
+        if self.nshextra:
+            nsiscript=nsiscript.replace('@nshextra@',
+                                        self.nsis_path(self.nshextra))
+
+        nsiscript = nsiscript.replace("@srcdir@", self.nsis_path(os.getcwd()))
+
+        # icon files
+        # XXX todo: make icons configurable
+        nsiscript = nsiscript.replace(
+            "@ico_install@",
+            self.nsis_path(os.path.join(os.path.dirname(__file__), "python-install.ico"), True))
+        nsiscript = nsiscript.replace(
+            "@ico_uninstall@",
+            self.nsis_path(os.path.join(os.path.dirname(__file__), "python-uninstall.ico"), True))
+        nsiscript = nsiscript.replace("@header_bitmap@",
+                                      self.nsis_path(self.headerbitmap, True))
+        nsiscript = nsiscript.replace("@welcome_bitmap@",
+                                      self.nsis_path(self.bitmap, True))
+        if self.minify_script:
+            nsiscript = minify_nsi(nsiscript)
+        nsifile=open(os.path.join(self.bdist_dir,'setup.nsi'),'wt')
+        nsifile.write(nsiscript)
+        nsifile.close()
+
+        if self.analyze_script:
+            report = json.dumps(analyze_nsi(nsiscript, regions),
+                                indent=1, sort_keys=True)
+            if self.analyze_script == '-':
+                print(report)
+            else:
+                log.info("writing script analysis to %s", self.analyze_script)
+                report_file = open(self.analyze_script, 'wt')
+                report_file.write(report)
+                report_file.close()
+
+        # metadata and feature flags, passed to makensis as /D options
+        defines = [
+            ('PRODUCT_NAME', metadata.name or ""),
+            ('PRODUCT_KEY',
+             '-' + self.productkey if self.productkey else ""),
+            ('PRODUCT_VERSION', metadata.version or ""),
+            ('PRODUCT_PUBLISHER', "%s <%s>" % (metadata.author or "",
+                                               metadata.author_email or "")),
+            ('PRODUCT_WEB_SITE', metadata.url or ""),
+            ('BDIST_NSI_NSH', self.abspath(
+                os.path.join(os.path.dirname(__file__), "bdist_nsi.nsh"))),
+            ]
+        for name, enabled in [
+                ('MISC_COMPILE', not self.no_target_compile),
+                ('MISC_OPTIMIZE', not self.no_target_optimize),
+                ('MISC_NSHEXTRA', self.nshextra),
+                ] + [('MISC_' + feature.upper(), getattr(self, feature))
+                     for feature in FEATURES]:
+            if enabled:
+                defines.append((name, "1"))
+        self.nsis_defines[os.path.join(self.bdist_dir, 'setup.nsi')] = (
+            defines)
+
+        # manifest of all files in this release, for future patches;
+        # run_makensis publishes it next to the installer
+        if not self.dry_run:
+            manifest_file = open(manifest_staged, 'wt')
+            json.dump({'name': self.distribution.get_name(),
+                       'version': self.distribution.get_version(),
+                       'files': manifest_files},
+                      manifest_file, indent=1, sort_keys=True)
+            manifest_file.close()
+        return os.path.join(self.bdist_dir,'setup.nsi')
+        
+
+    def get_removed_commands(self, removed, suffix=''):
+        """Return NSIS commands which remove the given files (paths
+        relative to the staging folder) from an earlier install, as needed
+        when upgrading with a patch installer. The suffix makes all labels
+        unique.
+        """
+        _c = []
+        for variable in ("$3", "$4", "$5"):
+            outfiles = [get_install_path(path) for path in removed]
+            outfiles = [outfile for outfile in outfiles
+                        if outfile and outfile.startswith(variable + "\\")]
+            if not outfiles:
+                continue
+            tag = 'removed%s%s' % (variable[1:], suffix)
+            _c.append('  ; remove files which are no longer shipped\n')
+            _c.append('  StrCmp %s "" end_%s 0\n' % (variable, tag))
+            for outfile in outfiles:
+                _c.append('  Delete "%s"\n' % outfile)
+                if outfile.lower().endswith(".py"):
+                    _c.append('  Delete "%so"\n' % outfile)
+                    _c.append('  Delete "%sc"\n' % outfile)
+            _c.append('end_%s:\n\n' % tag)
+        return _c
+
+    def get_file_commands(self, files, py_dirname='_python', suffix='',
+                          cache=None, unchanged=None,
+                          component_indices=None, root_sizes=None):
+        """Return NSIS commands which install the given files (as
+        returned by visit) from the py_dirname folder, NSIS commands which
+        remove them, and an estimate of their installed size (only if
+        fast_size is set). The suffix makes all labels unique. Files in
+        unchanged are removed but not installed. The files of the roots
+        in site-packages which component_indices maps to an index are only
+        installed if that component is selected. The estimated size of
+        each root is added to root_sizes, if given (also only if
+        fast_size is set).
+        """
+        # total size (only counted here if we do not compile for it)
+        pysize = 0
 
         # install folders and files (as nsis commands)
         _f_packages=[]
@@ -815,29 +2926,66 @@ class bdist_nsi(Command):
         _r_packages=[]
         _r_scripts=[]
         _r_include=[]
-        lastdir=""
-        for each in files:
+        # install already compressed files (as nsis commands)
+        _s_packages=[]
+        _s_scripts=[]
+        _s_include=[]
+        # scripts with a #!python line, for the target's interpreter
+        _x_scripts=[]
+        # install files of optional components (as nsis commands)
+        _f_components={}
+        _s_components={}
+        # last output folder, of each component
+        lastdir={}
+        laststoreddir={}
+        for i, each in enumerate(files):
+            self.progress_event('progress', 'emit', payload=py_dirname,
+                                done=i, total=len(files))
             # skip egg info files
             if each[1].endswith(".egg-info"):
                 continue
+            if self.fast_size:
+                size = self.estimate_size(
+                    os.path.join(self.bdist_dir, py_dirname,
+                                 *each[1].split("\\")),
+                    cache)
+                pysize += size
+            component = 0
             if each[1].lower().startswith("lib\\site-packages\\"):
                 outpath = "$3\\%s" % each[0][18:]
                 outfile = "$3\\%s" % each[1][18:]
                 _f = _f_packages
                 _d = _d_packages
                 _r = _r_packages
+                _s = _s_packages
+                root = each[1][18:].split("\\")[0]
+                if self.fast_size and root_sizes is not None:
+                    root_sizes[root] = root_sizes.get(root, 0) + size
+                if component_indices and component_indices.get(root):
+                    component = component_indices[root]
+                    _f = _f_components.setdefault(component, [])
+                    _s = _s_components.setdefault(component, [])
             elif each[1].lower().startswith("scripts\\"):
                 outpath = "$4\\%s" % each[0][8:]
                 outfile = "$4\\%s" % each[1][8:]
                 _f = _f_scripts
                 _d = _d_scripts
                 _r = _r_scripts
+                _s = _s_scripts
+                if unchanged is None or each[1] not in unchanged:
+                    script = open(os.path.join(
+                        self.bdist_dir, py_dirname, *each[1].split("\\")),
+                        'rb')
+                    if re.match(br'#!pythonw?(\s|$)', script.read(10)):
+                        _x_scripts.append(outfile)
+                    script.close()
             elif each[1].lower().startswith("include\\"):
                 outpath = "$5\\%s" % each[0][8:]
                 outfile = "$5\\%s" % each[1][8:]
                 _f = _f_include
                 _d = _d_include
                 _r = _r_include
+                _s = _s_include
             else:
                 log.warn("warning: ignoring %s" % each[1])
                 continue
@@ -852,14 +3000,48 @@ class bdist_nsi(Command):
                 if root not in _r:
                     _r.append(root)
 
-            if lastdir != each[0]:
-                lastdir=each[0]
-                _f.append('  SetOutPath "%s"\n' % outpath)
-            _f.append('  File "_python\\'+each[1]+'\"\n')
             _d.append('  Delete "%s"\n' % outfile)
             if outfile.lower().endswith(".py"):
                 _d.append('  Delete "%so"\n' % outfile)
                 _d.append('  Delete "%sc"\n' % outfile)
+            if unchanged is not None and each[1] in unchanged:
+                continue
+
+            if self.store_incompressible and is_incompressible(
+                    os.path.join(self.bdist_dir, py_dirname,
+                                 *each[1].split("\\"))):
+                if laststoreddir.get(component) != each[0]:
+                    laststoreddir[component]=each[0]
+                    _s.append('  SetOutPath "%s"\n' % outpath)
+                _s.append('  File "%s\\%s"\n' % (py_dirname, each[1]))
+                continue
+
+            if lastdir.get(component) != each[0]:
+                lastdir[component]=each[0]
+                _f.append('  SetOutPath "%s"\n' % outpath)
+            _f.append('  File "%s\\%s"\n' % (py_dirname, each[1]))
+
+        # already compressed files are stored as they are
+        for _f, _s in zip([_f_packages, _f_scripts, _f_include]
+                          + [_f_components[component]
+                             for component in sorted(_f_components)],
+                          [_s_packages, _s_scripts, _s_include]
+                          + [_s_components[component]
+                             for component in sorted(_f_components)]):
+            if _s:
+                _f.append('  SetCompress off\n')
+                _f += _s
+                _f.append('  SetCompress auto\n')
+
+        # optional components, if selected
+        for component, _f in sorted(_f_components.items()):
+            if not _f:
+                continue
+            _f_packages.append(
+                '  StrCmp $COMPONENT_%i "0" end_component_%i%s 0\n'
+                % (component, component, suffix))
+            _f_packages += _f
+            _f_packages.append('end_component_%i%s:\n' % (component, suffix))
 
         # remove folders
         for _d, _r, tag in zip([_d_packages, _d_scripts, _d_include],
@@ -870,216 +3052,955 @@ class bdist_nsi(Command):
                 if root.endswith("\\"):
                     _d.append('  RmDir /r "%s"\n' % root)
 
-        # 2to3, compile, optimize
+        if self.install_timing:
+            for _f, tag in zip([_f_packages, _f_scripts, _f_include],
+                               ['packages', 'scripts', 'include']):
+                if _f:
+                    _f.insert(0, '  !insertmacro TIMING_MARK "begin files %s $2"\n' % tag)
+                    _f.append('  !insertmacro TIMING_MARK "end files %s $2"\n' % tag)
+
+        # point scripts from wheels at the interpreter of the target
+        if _x_scripts:
+            _f_scripts.append('  StrCmp $1 "" end_shebang%s 0\n' % suffix)
+            for outfile in _x_scripts:
+                _f_scripts.append(
+                    '  nsExec::ExecToLog `"$1" -c "%s" "%s"`\n'
+                    % (SHEBANG_SCRIPT, outfile))
+            _f_scripts.append('end_shebang%s:\n' % suffix)
+
+        # compile, optimize
         for _f, _r, tag in zip([_f_packages, _f_scripts],
                                [_r_packages, _r_scripts],
                                ['packages', 'scripts']):
             if not _r:
                 continue
-            # 2to3
-            _f.append('  !ifdef MISC_2TO3\n')
-            _f.append('  Push $9\n')
-            _f.append('  StrCmp $0 "" end_2to3_%s 0 ; only run if we have a full python install\n' % tag)
-            _f.append('  StrCmp $1 "" end_2to3_%s 0 ; only run if we have an executable\n' % tag)
-            _f.append('  StrCpy $9 "$2" 1\n')
-            _f.append('  StrCmp $9 "3" 0 end_2to3_%s\n' % tag)
-            _f.append('  SetOutPath "$0"\n')
-            for root in _r:
-                _f.append("""  nsExec::ExecToLog "$1 $\\"$0\\Tools\\Scripts\\2to3.py$\\" -w -n $\\"%s$\\""\n""" % root.rstrip("\\"))
-            _f.append('end_2to3_%s:\n' % tag)
-            _f.append('  Pop $9\n')
-            _f.append('  !endif\n')
             # compile modules
             _f.append('  !ifdef MISC_COMPILE\n')
-            _f.append('  StrCmp $0 "" end_compile_%s 0 ; only run if we have a full python install\n' % tag)
-            _f.append('  StrCmp $1 "" end_compile_%s 0 ; only run if we have an executable\n' % tag)
+            if self.install_timing:
+                _f.append('  !insertmacro TIMING_MARK "begin compile %s $2"\n' % tag)
+            _f.append('  StrCmp $0 "" end_compile_%s%s 0 ; only run if we have a full python install\n' % (tag, suffix))
+            _f.append('  StrCmp $1 "" end_compile_%s%s 0 ; only run if we have an executable\n' % (tag, suffix))
             _f.append('  SetOutPath "$0"\n')
-            for root in _r:
+            for i, root in enumerate(_r):
                 if root.endswith("\\"):
-                    _f.append("""  nsExec::ExecToLog "$1 -c $\\"import compileall; compileall.compile_dir('%s')$\\""\n""" % root.replace("\\", "\\\\"))
+                    line = """  nsExec::ExecToLog "$1 -c $\\"import compileall; compileall.compile_dir('%s')$\\""\n""" % root.replace("\\", "\\\\")
+                elif root.lower().endswith(".py"):
+                    line = """  nsExec::ExecToLog "$1 -c $\\"import py_compile; py_compile.compile('%s')$\\""\n""" % root.replace("\\", "\\\\")
+                else:
+                    continue
+                if tag == 'packages' and component_indices and (
+                        component_indices.get(root[3:].rstrip("\\"))):
+                    # skip the component if it is not selected
+                    _f.append('  StrCmp $COMPONENT_%i "0" skip_compile_%s%s_%i\n'
+                              % (component_indices[root[3:].rstrip("\\")],
+                                 tag, suffix, i))
+                    _f.append(line)
+                    _f.append('skip_compile_%s%s_%i:\n' % (tag, suffix, i))
                 else:
-                    _f.append("""  nsExec::ExecToLog "$1 -c $\\"import py_compile; py_compile.compile('%s')$\\""\n""" % root.replace("\\", "\\\\"))
-            _f.append('end_compile_%s:\n' % tag)
+                    _f.append(line)
+            _f.append('end_compile_%s%s:\n' % (tag, suffix))
+            if self.install_timing:
+                _f.append('  !insertmacro TIMING_MARK "end compile %s $2"\n' % tag)
             _f.append('  !endif\n')
             _f.append('  !ifdef MISC_OPTIMIZE\n')
-            _f.append('  StrCmp $0 "" end_optimize_%s 0 ; only run if we have a full python install\n' % tag)
-            _f.append('  StrCmp $1 "" end_optimize_%s 0 ; only run if we have an executable\n' % tag)
+            if self.install_timing:
+                _f.append('  !insertmacro TIMING_MARK "begin optimize %s $2"\n' % tag)
+            _f.append('  StrCmp $0 "" end_optimize_%s%s 0 ; only run if we have a full python install\n' % (tag, suffix))
+            _f.append('  StrCmp $1 "" end_optimize_%s%s 0 ; only run if we have an executable\n' % (tag, suffix))
             _f.append('  SetOutPath "$0"\n')
-            for root in _r:
+            for i, root in enumerate(_r):
                 if root.endswith("\\"):
-                    _f.append("""  nsExec::ExecToLog "$1 -OO -c $\\"import compileall; compileall.compile_dir('%s')$\\""\n""" % root.replace("\\", "\\\\"))
+                    line = """  nsExec::ExecToLog "$1 -OO -c $\\"import compileall; compileall.compile_dir('%s')$\\""\n""" % root.replace("\\", "\\\\")
+                elif root.lower().endswith(".py"):
+                    line = """  nsExec::ExecToLog "$1 -OO -c $\\"import py_compile; py_compile.compile('%s')$\\""\n""" % root.replace("\\", "\\\\")
                 else:
-                    _f.append("""  nsExec::ExecToLog "$1 -OO -c $\\"import py_compile; py_compile.compile('%s')$\\""\n""" % root.replace("\\", "\\\\"))
-            _f.append('end_optimize_%s:\n' % tag)
+                    continue
+                if tag == 'packages' and component_indices and (
+                        component_indices.get(root[3:].rstrip("\\"))):
+                    _f.append('  StrCmp $COMPONENT_%i "0" skip_optimize_%s%s_%i\n'
+                              % (component_indices[root[3:].rstrip("\\")],
+                                 tag, suffix, i))
+                    _f.append(line)
+                    _f.append('skip_optimize_%s%s_%i:\n' % (tag, suffix, i))
+                else:
+                    _f.append(line)
+            _f.append('end_optimize_%s%s:\n' % (tag, suffix))
+            if self.install_timing:
+                _f.append('  !insertmacro TIMING_MARK "end optimize %s $2"\n' % tag)
             _f.append('  !endif\n')
 
         _f = []
 
         _f.append('  ; packages\n')
-        _f.append('  StrCmp $3 "" end_packages 0\n')
+        _f.append('  StrCmp $3 "" end_packages%s 0\n' % suffix)
         _f += _f_packages
-        _f.append('end_packages:\n\n')
+        _f.append('end_packages%s:\n\n' % suffix)
         _f.append('  ; scripts\n')
-        _f.append('  StrCmp $4 "" end_scripts 0\n')
+        _f.append('  StrCmp $4 "" end_scripts%s 0\n' % suffix)
         _f += _f_scripts
-        _f.append('end_scripts:\n\n')
+        _f.append('end_scripts%s:\n\n' % suffix)
         _f.append('  ; headers\n')
-        _f.append('  StrCmp $5 "" end_include 0\n')
+        _f.append('  StrCmp $5 "" end_include%s 0\n' % suffix)
         _f += _f_include
-        _f.append('end_include:\n\n')
+        _f.append('end_include%s:\n\n' % suffix)
 
         _d = []
 
         _d.append('  ; packages\n')
-        _d.append('  StrCmp $3 "" end_clean_packages 0\n')
+        _d.append('  StrCmp $3 "" end_clean_packages%s 0\n' % suffix)
         _d += _d_packages
         _d.append('  Delete "$3\\${PRODUCT_NAME}*.egg-info"\n')
-        _d.append('end_clean_packages:\n\n')
+        _d.append('end_clean_packages%s:\n\n' % suffix)
         _d.append('  ; scripts\n')
-        _d.append('  StrCmp $4 "" end_clean_scripts 0\n')
+        _d.append('  StrCmp $4 "" end_clean_scripts%s 0\n' % suffix)
         _d += _d_scripts
-        _d.append('end_clean_scripts:\n\n')
+        _d.append('end_clean_scripts%s:\n\n' % suffix)
         _d.append('  ; headers\n')
-        _d.append('  StrCmp $5 "" end_clean_include 0\n')
+        _d.append('  StrCmp $5 "" end_clean_include%s 0\n' % suffix)
         _d += _d_include
-        _d.append('end_clean_include:\n\n')
-
-        _d.append('  ; remove clutter\n')
-        _d.append('  StrCmp $0 "" end_clean_clutter 0\n')
-        _d.append('  Delete "$0\\Remove${PRODUCT_NAME}.*"\n')
-        _d.append('  Delete "$0\\${PRODUCT_NAME}-wininst.log"\n')
-        _d.append('end_clean_clutter:\n\n')
-
-        nsiscript=nsiscript.replace('@_files@',''.join(_f))
-        nsiscript=nsiscript.replace('@_deletefiles@',''.join(_d))
-
-        abs_py_dir = os.path.abspath(self.bdist_dir+os.sep+'_python')
-        if not self.no_target_compile:
-            nsiscript=nsiscript.replace('@compile@','')
-            print(sys.executable +
-                  ' -c "import compileall; compileall.compile_dir(\'%s\')"'
-                  % (abs_py_dir.replace('\\', '\\\\')))
-            # compile folder - for size calculation below
-            subprocess.call([sys.executable,
-                             '-c', 'import compileall; compileall.compile_dir(\'%s\')'
-                             % (abs_py_dir.replace('\\', '\\\\'))])
-        else:
-            nsiscript=nsiscript.replace('@compile@',';')        
-            
-        if not self.no_target_optimize:
-            nsiscript=nsiscript.replace('@optimize@','')
-            # compile folder - for size calculation below
-            subprocess.call([sys.executable,
-                             '-OO', '-c', 'import compileall; compileall.compile_dir(\'%s\')'
-                             % (abs_py_dir.replace('\\', '\\\\'))])
-        else:
-            nsiscript=nsiscript.replace('@optimize@',';')
-
-        # get total size
-        def round4k(x):
-            """Round number up to closest 4k boundary (disk space is allocated
-            in chunks of 4k so this 'fixes' the file size).
-            """
-            return (1 + (x // 4096)) * 4096
-        pysize = sum(
-            sum(round4k(os.path.getsize(os.path.join(dirpath, filename)))
-                for filename in filenames)
-            for dirpath, dirnames, filenames
-            in os.walk(self.bdist_dir+os.sep+'_python'))
-        nsiscript=nsiscript.replace('@pysizekb@', str(1 + (pysize // 1000)))
-        
-        if self.run2to3:
-            nsiscript=nsiscript.replace('@2to3@','')
-        else:
-            nsiscript=nsiscript.replace('@2to3@',';')   
-
-        if self.msvc2005:
-            nsiscript=nsiscript.replace('@msvc2005@','')
-        else:
-            nsiscript=nsiscript.replace('@msvc2005@',';')   
+        _d.append('end_clean_include%s:\n\n' % suffix)
 
-        if self.msvc2005sp1:
-            nsiscript=nsiscript.replace('@msvc2005sp1@','')
-        else:
-            nsiscript=nsiscript.replace('@msvc2005sp1@',';')   
-
-        if self.msvc2008:
-            nsiscript=nsiscript.replace('@msvc2008@','')
-        else:
-            nsiscript=nsiscript.replace('@msvc2008@',';')   
+        return _f, _d, pysize
 
-        if self.msvc2008sp1:
-            nsiscript=nsiscript.replace('@msvc2008sp1@','')
-        else:
-            nsiscript=nsiscript.replace('@msvc2008sp1@',';')   
-
-        if self.nshextra:
-            nsiscript=nsiscript.replace('@hasnshextra@','')
-            nsiscript=nsiscript.replace('@nshextra@', self.nshextra)
-        else:
-            nsiscript=nsiscript.replace('@hasnshextra@',';')   
-
-        if self.maya:
-            nsiscript=nsiscript.replace('@maya@','')
-        else:
-            nsiscript=nsiscript.replace('@maya@',';')   
-
-        if self.blender:
-            nsiscript=nsiscript.replace('@blender@','')
-        else:
-            nsiscript=nsiscript.replace('@blender@',';')   
-
-        if self.debug:
-            nsiscript=nsiscript.replace('@debug@','')
-        else:
-            nsiscript=nsiscript.replace('@debug@',';')   
-
-        nsiscript = nsiscript.replace("@srcdir@", self.abspath(os.getcwd()))
-
-        if not self.productkey:
-            nsiscript = nsiscript.replace('@key@', '')
-        else:
-            nsiscript = nsiscript.replace('@key@', '-' + self.productkey)
-
-        # icon files
-        # XXX todo: make icons configurable
-        nsiscript = nsiscript.replace(
-            "@ico_install@",
-            self.abspath(os.path.join(os.path.dirname(__file__), "python-install.ico")))
-        nsiscript = nsiscript.replace(
-            "@ico_uninstall@",
-            self.abspath(os.path.join(os.path.dirname(__file__), "python-uninstall.ico")))
-        nsiscript = nsiscript.replace("@header_bitmap@", self.headerbitmap)
-        nsiscript = nsiscript.replace("@welcome_bitmap@", self.bitmap)
-        nsifile=open(os.path.join(self.bdist_dir,'setup.nsi'),'wt')
-        nsifile.write(nsiscript)
-        nsifile.close()
-        self.compile()
-        
-
-    def visit(self,arg,dir,fil):
+    def visit(self,arg,dir,fil,py_dir=None):
+        if py_dir is None:
+            py_dir = self.bdist_dir+os.sep+'_python'
         for each in fil:
             if not os.path.isdir(dir+os.sep+each):
-                f=str(dir+os.sep+each)[len(self.bdist_dir+os.sep+'_python'+os.sep):]
+                f=str(dir+os.sep+each)[len(py_dir+os.sep):]
                 # replace / by \\ so it works on linux too
                 arg.append([os.path.dirname(f).replace("/", "\\"),
                             f.replace("/", "\\")])
                 
-    def compile(self):
+    def zip_payload(self, py_dirname='_python', version=None):
+        """Replace the packages and modules in site-packages of the
+        py_dirname staging folder which can be imported from a zip file
+        by a single zip file, and a .pth file which adds it to sys.path.
+        Both are named without the version, so an upgrade replaces them.
+        If zip_bytecode is set and version is the running python
+        version, then the zip file contains bytecode instead of source.
+        """
+        site_packages = os.path.join(
+            self.bdist_dir, py_dirname, 'Lib', 'site-packages')
+        if not os.path.isdir(site_packages):
+            return
+        roots = []
+        for name in sorted(os.listdir(site_packages)):
+            path = os.path.join(site_packages, name)
+            if name.endswith('.py') or os.path.isfile(
+                    os.path.join(path, '__init__.py')):
+                if is_zip_safe(path):
+                    roots.append(name)
+                else:
+                    log.info("zip: keeping %s as loose files", name)
+        if not roots:
+            return
+        bytecode = self.zip_bytecode
+        if bytecode and version != get_python_version():
+            log.warn("warning: cannot compile bytecode for python %s,"
+                     " zipping sources instead", version or "any version")
+            bytecode = False
+        zipname = "%s.zip" % self.distribution.get_name()
+        log.info("zip: packing %s into %s", ", ".join(roots), zipname)
+        if self.dry_run:
+            return
+        zipfile_ = zipfile.ZipFile(
+            os.path.join(site_packages, zipname), 'w', zipfile.ZIP_STORED)
+        for folder, path in scan_files(site_packages):
+            path = path.replace("\\", "/")
+            if path.split("/")[0] not in roots:
+                continue
+            filename = os.path.join(site_packages, *path.split("/"))
+            if self.reproducible:
+                epoch = get_source_date_epoch()
+                os.utime(filename, (epoch, epoch))
+            stream = open(filename, 'rb')
+            data = stream.read()
+            stream.close()
+            if bytecode:
+                # sourceless, so zipimport does not check the time stamp
+                data = get_bytecode_header(filename) + marshal.dumps(
+                    compile(data, path, 'exec'))
+                path = path[:-3] + '.pyc'
+            if self.reproducible:
+                date_time = time.gmtime(epoch)[:6]
+            else:
+                date_time = time.localtime(os.path.getmtime(filename))[:6]
+            zipfile_.writestr(zipfile.ZipInfo(path, date_time), data)
+        zipfile_.close()
+        for root in roots:
+            path = os.path.join(site_packages, root)
+            if os.path.isdir(path):
+                remove_tree(path)
+            else:
+                os.remove(path)
+        pthfile = open(os.path.join(
+            site_packages, "%s.pth" % self.distribution.get_name()), 'w')
+        pthfile.write(zipname + "\n")
+        pthfile.close()
+
+    def filter_payload(self, py_dirname='_python'):
+        """Remove the files which the include and exclude options leave
+        out from the py_dirname staging folder, before anything else is
+        done with them, and report how much each rule saved.
+        """
+        if not (self.include or self.exclude):
+            return
+        py_dir = os.path.join(self.bdist_dir, py_dirname)
+        savings = {}
+        for folder, path in scan_files(py_dir):
+            install_path = get_install_path(path)
+            if install_path is None:
+                continue
+            rule = get_filter_rule(
+                install_path[3:].replace("\\", "/"),
+                self.include, self.exclude)
+            if rule is None:
+                continue
+            filename = os.path.join(py_dir, *path.split("\\"))
+            count, size = savings.get(rule, (0, 0))
+            savings[rule] = (count + 1, size + os.path.getsize(filename))
+            if not self.dry_run:
+                os.remove(filename)
+        for rule, (count, size) in sorted(savings.items()):
+            log.info("%s: left out %i files, %i bytes", rule, count, size)
+
+    def estimate_size(self, path, cache=None):
+        """Estimate the disk space taken by the installed file, including
+        the bytecode compiled for it on the target system. The bytecode
+        size is taken from the cache if possible, and otherwise is
+        estimated from the source size.
+        """
+        size = os.path.getsize(path)
+        total = round4k(size)
+        if not path.endswith('.py'):
+            return total
+        data = None
+        for optimize, skip in ((0, self.no_target_compile),
+                               (2, self.no_target_optimize)):
+            if skip:
+                continue
+            bytecode_size = None
+            if cache is not None:
+                if data is None:
+                    srcfile = open(path, 'rb')
+                    data = srcfile.read()
+                    srcfile.close()
+                cpath = cache.get(get_bytecode_key(data, optimize))
+                if cpath is not None:
+                    bytecode_size = (os.path.getsize(cpath)
+                                     + len(get_bytecode_header(path)))
+            if bytecode_size is None:
+                bytecode_size = int(size * BYTECODE_SIZE_RATIO[optimize])
+            total += round4k(bytecode_size)
+        return total
+
+    def convert_2to3(self, src_dirname, dst_dirname):
+        """Convert all modules in the src_dirname staging folder with 2to3,
+        writing them to the dst_dirname staging folder (which can be
+        the same). Conversions are cached in cache_dir, if set, and the
+        remaining modules are converted by parallel 2to3 processes.
+        """
+        src_dir = os.path.join(self.bdist_dir, src_dirname)
+        dst_dir = os.path.join(self.bdist_dir, dst_dirname)
+        if src_dir != dst_dir:
+            if os.path.exists(dst_dir):
+                remove_tree(dst_dir, dry_run=self.dry_run)
+            copy_tree(src_dir, dst_dir, verbose=0, dry_run=self.dry_run)
+        if self.cache_dir:
+            cache = BuildCache(os.path.join(self.cache_dir, '2to3'),
+                               max_size=self.cache_size * 1024 * 1024)
+        else:
+            cache = None
+        hits = 0
+        misses = []
+        for dirpath, dirnames, filenames in os.walk(dst_dir):
+            for filename in filenames:
+                if not filename.endswith('.py'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if cache is None:
+                    misses.append((path, None))
+                    continue
+                srcfile = open(path, 'rb')
+                sha1 = hashlib.sha1()
+                sha1.update(("2to3 %s\n" % sys.version).encode("ascii"))
+                # the import fixer converts imports of sibling modules
+                # to relative imports, so the key includes the siblings
+                sha1.update(("%s\n%s\n" % (
+                    os.path.relpath(path, dst_dir).replace(os.sep, '/'),
+                    " ".join(sorted(dirnames + filenames)))).encode("utf-8"))
+                sha1.update(srcfile.read())
+                srcfile.close()
+                key = sha1.hexdigest()
+                cpath = cache.get(key)
+                if cpath is None:
+                    misses.append((path, key))
+                    continue
+                copy_file(cpath, path, preserve_times=0, verbose=0)
+                hits += 1
+        log.info("2to3: %i cached, %i to convert", hits, len(misses))
+        if not misses:
+            return
+        try:
+            import lib2to3
+        except ImportError:
+            raise DistutilsExecError(
+                "run2to3 needs lib2to3, which python %s does not have"
+                " (it was removed in python 3.13); run bdist_nsi with an"
+                " older python, or convert the package before building"
+                % get_python_version())
+        # distribute modules over processes, and keep command lines short
+        paths = [path for path, key in misses]
+        chunk_size = max(1, min(100, len(paths) // multiprocessing.cpu_count()))
+        commands = [
+            [sys.executable, '-m', 'lib2to3', '-w', '-n', '--no-diffs']
+            + paths[i:i + chunk_size]
+            for i in range(0, len(paths), chunk_size)]
+        if run_parallel(commands, dry_run=self.dry_run,
+                        jobs=multiprocessing.cpu_count()):
+            raise DistutilsExecError("2to3 conversion failed")
+        if cache is not None:
+            for path, key in misses:
+                dstfile = open(path, 'rb')
+                cache.put(key, dstfile.read())
+                dstfile.close()
+            cache.prune()
+
+    def compile_bytecode(self, py_dir, optimize=0, cache=None,
+                         payload=None, done=0, total=None):
+        """Compile all modules in py_dir, with -OO if optimize is 2.
+        If a cache is given, then bytecode is taken from the cache
+        wherever possible, and only the remaining modules are compiled.
+        Progress of the compile phase is reported counting on from done,
+        and the new count is returned.
+        """
+        if self.dry_run:
+            return done
+        hits = 0
+        misses = []
+        for dirpath, dirnames, filenames in os.walk(py_dir):
+            for filename in filenames:
+                if not filename.endswith('.py'):
+                    continue
+                source = os.path.join(dirpath, filename)
+                cfile = get_bytecode_path(source, optimize)
+                if cache is None:
+                    misses.append((source, cfile, None))
+                    continue
+                srcfile = open(source, 'rb')
+                key = get_bytecode_key(srcfile.read(), optimize)
+                srcfile.close()
+                path = cache.get(key)
+                if path is None:
+                    misses.append((source, cfile, key))
+                    continue
+                self.mkpath(os.path.dirname(cfile))
+                bodyfile = open(path, 'rb')
+                cfile_ = open(cfile, 'wb')
+                cfile_.write(get_bytecode_header(source))
+                cfile_.write(bodyfile.read())
+                cfile_.close()
+                bodyfile.close()
+                hits += 1
+                done += 1
+                self.progress_event('progress', 'compile', payload=payload,
+                                    done=done, total=total)
+        if cache is not None:
+            log.info("bytecode cache: %i hits, %i misses (optimize=%i)",
+                     hits, len(misses), optimize)
+        if not misses:
+            return done
+        cmd = [sys.executable, '-c', COMPILE_SCRIPT]
+        if optimize:
+            cmd.insert(1, '-OO')
+        log.info("compiling %i modules in %s (optimize=%i)",
+                 len(misses), py_dir, optimize)
+        # the modules go through a file, rather than a pipe, so reading
+        # the progress cannot block writing them
+        sources = tempfile.TemporaryFile('w+')
+        sources.write("".join("%s\t%s\n" % (source, cfile)
+                              for source, cfile, key in misses))
+        sources.seek(0)
+        compiler = subprocess.Popen(cmd, stdin=sources,
+                                    stdout=subprocess.PIPE,
+                                    universal_newlines=True)
+        for line in iter(compiler.stdout.readline, ''):
+            done += 1
+            self.progress_event('progress', 'compile', payload=payload,
+                                done=done, total=total)
+        compiler.wait()
+        sources.close()
+        if cache is None:
+            return done
+        for source, cfile, key in misses:
+            # modules with syntax errors are not compiled
+            if os.path.exists(cfile):
+                header_size = len(get_bytecode_header(source))
+                cfile_ = open(cfile, 'rb')
+                cache.put(key, cfile_.read()[header_size:])
+                cfile_.close()
+        return done
+
+    def validate(self, nsifile):
+        # catch mistakes in the script, and in nshextra, before makensis
+        defines = dict(self.nsis_defines.get(nsifile, []))
+        nsiscript = open(nsifile)
+        errors = validate_nsi(nsiscript.read(), filename=nsifile,
+                              base_dir=os.path.dirname(nsifile),
+                              defines=defines, known=MISC_FLAGS)
+        nsiscript.close()
+        for error in errors:
+            log.error(error)
+        if errors:
+            raise DistutilsExecError(
+                "%i errors in %s (see --no-validate-script)"
+                % (len(errors), nsifile))
+
+    def compile(self, nsifiles=None):
+        if nsifiles is None:
+            nsifiles = [os.path.join(self.bdist_dir, 'setup.nsi')]
+        elif not isinstance(nsifiles, list):
+            nsifiles = [nsifiles]
         if self.nsis_dir is not None:
             # create destination directory
             # (nsis complains if it does not yet exist)
             self.mkpath(self.dist_dir)
+            # makensis writes to a temporary file, which is renamed once
+            # complete, so nobody sees, or overwrites, a partial installer
+            commands = []
+            outfiles = []
+            for nsifile in nsifiles:
+                if not self.no_validate_script and os.path.exists(nsifile):
+                    self.validate(nsifile)
+                cmd = [self.nsis_dir]
+                for name, value in self.nsis_defines.get(nsifile, []):
+                    if value:
+                        cmd.append('-D%s=%s' % (name, value))
+                    else:
+                        cmd.append('-D%s' % name)
+                installer_path = self.installers.get(nsifile)
+                if installer_path is not None:
+                    # a define, rather than -X, so that no quotes are
+                    # needed on the command line
+                    outfile = "%s.%s.tmp" % (installer_path, get_run_name(''))
+                    cmd.append('-DMISC_OUTFILE=%s' % outfile)
+                    outfiles.append((outfile, installer_path))
+                else:
+                    outfiles.append(None)
+                cmd.append(nsifile)
+                commands.append(cmd)
+            try:
+                self.run_makensis(commands, outfiles)
+            finally:
+                # no partial installers, also if makensis failed to run
+                for paths in outfiles:
+                    if paths is not None and os.path.exists(paths[0]):
+                        os.remove(paths[0])
+
+    def run_makensis(self, commands, outfiles):
+        """Run the makensis commands, and publish the (outfile,
+        installer_path) pairs in outfiles of those which succeed, each
+        followed by the manifest of its release.
+        """
+        self.progress_event('start', 'makensis', total=len(commands))
+        if len(commands) == 1 and self.progress_hooks and not self.dry_run:
+            # pass the output on to the hooks, line by line
+            log.info(" ".join(commands[0]))
+            makensis = subprocess.Popen(
+                commands[0], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, universal_newlines=True)
+            for line in iter(makensis.stdout.readline, ''):
+                sys.stdout.write(line)
+                self.progress_event('output', 'makensis',
+                                    line=line.rstrip('\n'))
+            returncodes = [makensis.wait()]
+            if returncodes[0] != 0:
+                print("Warning: possible error during NSIS compilation.")
+        elif len(commands) == 1:
             try:
-                spawn([os.path.join(self.nsis_dir),
-                       os.path.join(self.bdist_dir, 'setup.nsi')])
-            except:
+                spawn(commands[0], dry_run=self.dry_run)
+            except DistutilsExecError:
+                print("Warning: possible error during NSIS compilation.")
+                returncodes = [1]
+            else:
+                returncodes = [0]
+        else:
+            returncodes = []
+            if run_parallel(commands, dry_run=self.dry_run,
+                            returncodes=returncodes):
                 print("Warning: possible error during NSIS compilation.")
+        self.progress_event('end', 'makensis',
+                            done=returncodes.count(0))
+        for returncode, paths in zip(returncodes, outfiles):
+            if paths is None:
+                continue
+            outfile, installer_path = paths
+            if returncode == 0 and os.path.exists(outfile):
+                log.info("publishing %s", installer_path)
+                publish_file(outfile, installer_path)
+                manifest_staged, manifest_path = self.manifests.get(
+                    installer_path, (None, None))
+                if manifest_staged and os.path.exists(manifest_staged):
+                    # copied, so that rerunning makensis publishes it again
+                    manifest_tmp = "%s.%s.tmp" % (
+                        manifest_path, get_run_name(''))
+                    copy_file(manifest_staged, manifest_tmp, verbose=0)
+                    publish_file(manifest_tmp, manifest_path)
 
-            
 # class bdist_nsi
 
-def get_nsi(target_versions=None, bits=None):
+LANGUAGES = [
+    "English", "French", "German", "Spanish", "SpanishInternational",
+    "SimpChinese", "TradChinese", "Japanese", "Korean", "Italian", "Dutch",
+    "Danish", "Swedish", "Norwegian", "NorwegianNynorsk", "Finnish",
+    "Greek", "Russian", "Portuguese", "PortugueseBR", "Polish", "Ukrainian",
+    "Czech", "Slovak", "Croatian", "Bulgarian", "Hungarian", "Thai",
+    "Romanian", "Latvian", "Macedonian", "Estonian", "Turkish",
+    "Lithuanian", "Slovenian", "Serbian", "SerbianLatin", "Arabic", "Farsi",
+    "Hebrew", "Indonesian", "Mongolian", "Luxembourgish", "Albanian",
+    "Breton", "Belarusian", "Icelandic", "Malay", "Bosnian", "Kurdish",
+    "Irish", "Uzbek", "Galician", "Afrikaans", "Catalan", "Esperanto",
+    ]
+
+# locale language codes of the languages, where they differ by country
+LANGUAGE_CODES = {
+    "en": "English", "fr": "French", "de": "German", "es": "Spanish",
+    "zh_CN": "SimpChinese", "zh_SG": "SimpChinese", "zh": "TradChinese",
+    "ja": "Japanese", "ko": "Korean", "it": "Italian", "nl": "Dutch",
+    "da": "Danish", "sv": "Swedish", "nb": "Norwegian", "no": "Norwegian",
+    "nn": "NorwegianNynorsk", "fi": "Finnish", "el": "Greek",
+    "ru": "Russian", "pt": "Portuguese", "pt_BR": "PortugueseBR",
+    "pl": "Polish", "uk": "Ukrainian", "cs": "Czech", "sk": "Slovak",
+    "hr": "Croatian", "bg": "Bulgarian", "hu": "Hungarian", "th": "Thai",
+    "ro": "Romanian", "lv": "Latvian", "mk": "Macedonian", "et": "Estonian",
+    "tr": "Turkish", "lt": "Lithuanian", "sl": "Slovenian", "sr": "Serbian",
+    "ar": "Arabic", "fa": "Farsi", "he": "Hebrew", "id": "Indonesian",
+    "mn": "Mongolian", "lb": "Luxembourgish", "sq": "Albanian",
+    "br": "Breton", "be": "Belarusian", "is": "Icelandic", "ms": "Malay",
+    "bs": "Bosnian", "ku": "Kurdish", "ga": "Irish", "uz": "Uzbek",
+    "gl": "Galician", "af": "Afrikaans", "ca": "Catalan", "eo": "Esperanto",
+    }
+
+def get_nsis_language(locale_name):
+    """Return the NSIS language for a locale name, or English if there
+    is none.
+
+    >>> get_nsis_language("fr_FR.UTF-8")
+    'French'
+    >>> get_nsis_language("pt_BR")
+    'PortugueseBR'
+    >>> get_nsis_language("zh_TW.Big5")
+    'TradChinese'
+    >>> get_nsis_language("C")
+    'English'
+    """
+    code = (locale_name or "").split(".")[0].split("@")[0]
+    return LANGUAGE_CODES.get(
+        code, LANGUAGE_CODES.get(code.split("_")[0], "English"))
+
+def get_languages(languages):
+    """Return the list of NSIS languages for the languages option: None
+    or "all" for all languages, "none" for English only, "auto" for the
+    language of the build machine, or a comma separated list.
+
+    >>> get_languages("none")
+    ['English']
+    >>> get_languages("german, english")
+    ['German', 'English']
+    >>> len(get_languages(None)) == len(LANGUAGES)
+    True
+    >>> get_languages("Klingon") # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    DistutilsOptionError: unknown language Klingon
+    """
+    if languages is None or languages.lower() == "all":
+        return list(LANGUAGES)
+    elif languages.lower() == "none":
+        return ["English"]
+    elif languages.lower() == "auto":
+        import locale
+        return [get_nsis_language(locale.getlocale()[0]
+                                  or os.environ.get("LANG"))]
+    names = dict((language.lower(), language) for language in LANGUAGES)
+    result = []
+    for language in languages.split(","):
+        language = language.strip()
+        if language.lower() not in names:
+            raise DistutilsOptionError("unknown language %s" % language)
+        result.append(names[language.lower()])
+    return result
+
+FEATURES = ('maya', 'blender', 'msvc2005', 'msvc2005sp1', 'msvc2008',
+            'msvc2008sp1', 'debug', 'install_timing', 'components')
+
+# flags which are passed to makensis, if set
+MISC_FLAGS = ('MISC_COMPILE', 'MISC_OPTIMIZE', 'MISC_NSHEXTRA') + tuple(
+    'MISC_' + feature.upper() for feature in FEATURES)
+
+# macros of the standard headers, which validate_nsi cannot read
+NSIS_HEADER_MACROS = (
+    'Locate', 'GetSize', 'DriveSpace', 'GetDrives', 'GetTime',
+    'GetFileAttributes', 'GetFileVersion', 'GetExeName', 'GetExePath',
+    'GetParameters', 'GetOptions', 'GetOptionsS', 'GetRoot', 'GetParent',
+    'GetFileName', 'GetBaseName', 'GetFileExt', 'BannerTrimPath',
+    'DirState', 'RefreshShellIcons', 'WordFind', 'WordFindS', 'WordFind2X',
+    'WordFind2XS', 'WordFind3X', 'WordFind3XS', 'WordReplace',
+    'WordReplaceS', 'WordAdd', 'WordAddS', 'WordInsert', 'WordInsertS',
+    'StrFilter', 'StrFilterS', 'VersionCompare', 'VersionConvert')
+
+def resolve_ifdefs(nsiscript, defined, known, keep_lines=False):
+    r"""Resolve the !ifdef and !ifndef blocks of nsiscript which only
+    test symbols in known, of which those in defined are defined. Other
+    blocks are kept. A !define outside kept blocks makes its symbol
+    known as well. With keep_lines, removed lines are left empty, so
+    line numbers do not change.
+
+    >>> print(resolve_ifdefs(
+    ...     "!ifdef A | B\n"
+    ...     "!define C\n"
+    ...     "!endif\n"
+    ...     "!ifdef A\n"
+    ...     "!define E\n"
+    ...     "!endif\n"
+    ...     "!ifndef E\n"
+    ...     "e\n"
+    ...     "!endif\n"
+    ...     "!ifndef C\n"
+    ...     "a\n"
+    ...     "!else\n"
+    ...     "b\n"
+    ...     "!endif\n"
+    ...     "!ifdef D\n"
+    ...     "  !ifdef A\n"
+    ...     "c\n"
+    ...     "  !endif ;A\n"
+    ...     "d\n"
+    ...     "!endif\n",
+    ...     defined=["B"], known=["A", "B", "C"]))
+    !define C
+    e
+    b
+    !ifdef D
+    d
+    !endif
+    <BLANKLINE>
+    >>> print(resolve_ifdefs(
+    ...     "!ifdef D\n"
+    ...     "  !ifdef A\n"
+    ...     "c\n"
+    ...     "  !endif ;A\n"
+    ...     "!endif\n",
+    ...     defined=["A"], known=["A"]))
+    !ifdef D
+    c
+    !endif
+    <BLANKLINE>
+    >>> print(resolve_ifdefs(
+    ...     "!ifdef D\n"
+    ...     "  !ifndef A\n"
+    ...     "c\n"
+    ...     "  !else\n"
+    ...     "d\n"
+    ...     "  !endif ;A\n"
+    ...     "!endif\n",
+    ...     defined=[], known=["A"]))
+    !ifdef D
+    c
+    !endif
+    <BLANKLINE>
+    """
+    defined = set(defined)
+    known = set(known)
+    lines = []
+    # stack of None for kept blocks, or of a flag for resolved blocks
+    stack = []
+    for line in nsiscript.splitlines(True):
+        words = line.split(';')[0].split()
+        directive = words[0] if words else ''
+        # kept blocks (None) are active, as makensis decides them
+        active = all(flag is not False for flag in stack)
+        keep = True
+        if directive in ('!ifdef', '!ifndef'):
+            symbols = [word for word in words[1:] if word != '|']
+            if active and symbols and set(symbols) <= known and (
+                    len(words) == 2 * len(symbols)):
+                flag = any(symbol in defined for symbol in symbols)
+                stack.append(flag == (directive == '!ifdef'))
+                keep = False
+            elif not active:
+                stack.append(False)
+                keep = False
+            else:
+                stack.append(None)
+        elif directive.startswith('!if'):
+            stack.append(None if active else False)
+        elif directive == '!else' and stack and stack[-1] is not None:
+            stack[-1] = not stack[-1]
+            keep = False
+        elif directive == '!endif' and stack:
+            if stack.pop() is not None:
+                keep = False
+        elif (directive == '!define' and None not in stack
+              and len(words) > 1):
+            known.add(words[1])
+            if active:
+                defined.add(words[1])
+        if keep and all(flag is not False for flag in stack):
+            lines.append(line)
+        elif keep_lines:
+            lines.append('\n')
+    return ''.join(lines)
+
+def minify_nsi(nsiscript):
+    r"""Strip comments, blank lines, and indentation from an NSIS
+    script.
+
+    >>> print(minify_nsi("\\\n; comment\n\nFunction a\n  # note\n  Nop ; x\nFunctionEnd\n"))
+    Function a
+    Nop ; x
+    FunctionEnd
+    <BLANKLINE>
+    """
+    lines = []
+    # join continued lines first, so continued comments are stripped
+    for line in re.sub(r'\\\n', '', nsiscript).splitlines():
+        line = line.strip()
+        if line and not line.startswith((';', '#')):
+            lines.append(line + '\n')
+    return ''.join(lines)
+
+def split_nsi_line(line):
+    r"""Split a line of an NSIS script into its words, without the
+    comment.
+
+    >>> split_nsi_line('  File /oname=a.txt "b c.txt" ; "d"')
+    ['File', '/oname=a.txt', '"b c.txt"']
+    >>> split_nsi_line('StrCpy $0 "say $\\"hi$\\"" # x')
+    ['StrCpy', '$0', '"say $\\"hi$\\""']
+    """
+    words = []
+    for word in re.findall(r'"(?:\$\\.|[^"])*"|\'(?:\$\\.|[^\'])*\''
+                           r'|`(?:\$\\.|[^`])*`|\S+', line):
+        if word.startswith((';', '#')):
+            break
+        words.append(word)
+    return words
+
+def validate_nsi(nsiscript, filename='setup.nsi', base_dir=None,
+                 defines=None, known=()):
+    r"""Check an NSIS script for the mistakes which would make makensis
+    fail, without running it, and return the errors, as
+    "filename:line: message" strings.
+
+    The checks are: unbalanced !if/!endif and !macro/!macroend,
+    unbalanced Function, Section, and SectionGroup blocks, duplicate
+    labels, !insertmacro of undefined macros, and leftover @placeholder@
+    tokens. defines maps the symbols passed to makensis to their values;
+    the !ifdef blocks which only test these, or symbols in known, are
+    resolved first. Readable !include files are checked too. If
+    base_dir, the folder from which makensis runs, is given, then
+    missing File sources and missing !include files are errors as well.
+
+    >>> for error in validate_nsi(
+    ...         "!ifdef A\n"
+    ...         "!macro M\n"
+    ...         "!macroend\n"
+    ...         "!endif\n"
+    ...         "Function f\n"
+    ...         "  !insertmacro M\n"
+    ...         "  !insertmacro N\n"
+    ...         "  done:\n"
+    ...         "  done:\n"
+    ...         "Section \"@name@\"\n"
+    ...         "SectionEnd\n"
+    ...         "!ifndef B\n", defines={"A": ""}):
+    ...     print(error)
+    setup.nsi:5: Function without FunctionEnd
+    setup.nsi:7: !insertmacro of undefined macro N
+    setup.nsi:9: duplicate label done (first at line 8)
+    setup.nsi:10: Section inside Function
+    setup.nsi:10: leftover placeholder @name@
+    setup.nsi:12: !ifndef without !endif
+    >>> validate_nsi("!ifdef A\n!macro M\n!macroend\n!endif\n"
+    ...              "!insertmacro M\n", known=["A"])
+    ['setup.nsi:5: !insertmacro of undefined macro M']
+    """
+    defines = dict(defines or {})
+    known = set(known) | set(defines)
+    macros = set(NSIS_HEADER_MACROS)
+    inserts = []
+    errors = []
+    seen = set()
+
+    def substitute(text):
+        return re.sub(r'\$\{([^}]*)\}',
+                      lambda match: defines.get(match.group(1),
+                                                match.group(0)),
+                      text)
+
+    def get_lines(text):
+        # join continued lines, keeping the number of their first line
+        lines = []
+        continued = None
+        for lineno, line in enumerate(text.splitlines(), 1):
+            if continued is not None:
+                line = continued[1] + line
+                lineno = continued[0]
+            if line.endswith('\\'):
+                continued = (lineno, line[:-1])
+            else:
+                continued = None
+                lines.append((lineno, line))
+        if continued is not None:
+            lines.append(continued)
+        return lines
+
+    def check(nsiscript, filename):
+        # preprocessor blocks, on the script as written
+        stack = []
+        for lineno, line in get_lines(nsiscript):
+            words = split_nsi_line(line)
+            directive = words[0].lower() if words else ''
+            if directive.startswith('!if'):
+                stack.append((words[0], lineno))
+            elif directive == '!else':
+                if not stack or stack[-1][0] == '!macro':
+                    errors.append((filename, lineno, "!else without !if"))
+            elif directive == '!endif':
+                if not stack or stack[-1][0] == '!macro':
+                    errors.append((filename, lineno, "!endif without !if"))
+                else:
+                    stack.pop()
+            elif directive == '!macro':
+                stack.append(('!macro', lineno))
+            elif directive == '!macroend':
+                while stack and stack[-1][0] != '!macro':
+                    errors.append((filename, stack[-1][1],
+                                   "%s without !endif" % stack.pop()[0]))
+                if not stack:
+                    errors.append((filename, lineno,
+                                   "!macroend without !macro"))
+                else:
+                    stack.pop()
+        for directive, lineno in stack:
+            errors.append((filename, lineno, "%s without %s" % (
+                directive,
+                '!macroend' if directive == '!macro' else '!endif')))
+        # everything else, on the script as makensis sees it
+        blocks = []
+        labels = {}
+        in_macro = False
+        for lineno, line in get_lines(resolve_ifdefs(
+                nsiscript, defined=defines, known=known, keep_lines=True)):
+            words = split_nsi_line(line)
+            if not words:
+                continue
+            for placeholder in re.findall(r'@[a-z_0-9]+@', ' '.join(words)):
+                errors.append((filename, lineno,
+                               "leftover placeholder %s" % placeholder))
+            command = words[0].lower()
+            if command == '!macro':
+                in_macro = True
+                if len(words) > 1:
+                    macros.add(words[1])
+                continue
+            elif command == '!macroend':
+                in_macro = False
+                continue
+            elif command == '!insertmacro' and len(words) > 1:
+                inserts.append((filename, lineno, words[1]))
+            if in_macro:
+                # bodies depend on the macro arguments, so are skipped
+                continue
+            if command in ('function', 'section', 'sectiongroup'):
+                if blocks and blocks[-1][0] in ('Function', 'Section'):
+                    errors.append((filename, lineno, "%s inside %s" % (
+                        words[0], blocks[-1][0])))
+                blocks.append((words[0], lineno))
+                labels = {}
+            elif command in ('functionend', 'sectionend', 'sectiongroupend'):
+                if not blocks or blocks[-1][0].lower() + 'end' != command:
+                    errors.append((filename, lineno, "%s without %s" % (
+                        words[0], words[0][:-3])))
+                else:
+                    blocks.pop()
+                labels = {}
+            elif (len(words) == 1 and words[0].endswith(':')
+                  and re.match(r'[A-Za-z_.][\w.]*:$', words[0])):
+                label = words[0][:-1]
+                if label in labels:
+                    errors.append((filename, lineno,
+                                   "duplicate label %s (first at line %i)"
+                                   % (label, labels[label])))
+                else:
+                    labels[label] = lineno
+            elif command == 'file' and base_dir is not None:
+                sources = []
+                options = iter(words[1:])
+                for word in options:
+                    if word.strip('"').lower() == '/nonfatal':
+                        sources = []
+                        break
+                    elif word.strip('"').lower() == '/x':
+                        next(options, None)
+                    elif not word.strip('"').startswith('/'):
+                        sources.append(word)
+                for source in sources:
+                    source = substitute(source.strip('"\'`'))
+                    if '$' in source:
+                        continue
+                    path = os.path.join(base_dir, source.replace('\\', '/'))
+                    if '/r' in [word.lower() for word in words]:
+                        path = os.path.dirname(path) or base_dir
+                    if not glob.glob(path):
+                        errors.append((filename, lineno,
+                                       "missing File source %s" % source))
+            elif command == '!include':
+                names = [word.strip('"\'`') for word in words[1:]
+                         if not word.strip('"').startswith('/')]
+                if (not names or '/NONFATAL' in [word.upper() for word in words]
+                        or '$' in substitute(names[0])):
+                    continue
+                name = substitute(names[0])
+                if os.path.isabs(name.replace('\\', '/')):
+                    path = name.replace('\\', '/')
+                elif base_dir is not None:
+                    path = os.path.join(base_dir, name.replace('\\', '/'))
+                else:
+                    continue
+                if os.path.isfile(path):
+                    if os.path.abspath(path) not in seen:
+                        seen.add(os.path.abspath(path))
+                        include = open(path)
+                        check(include.read(), name)
+                        include.close()
+                elif '/' in name or '\\' in name:
+                    errors.append((filename, lineno,
+                                   "missing !include file %s" % name))
+                # else a standard header, from the nsis include folder
+        for block, lineno in blocks:
+            errors.append((filename, lineno,
+                           "%s without %sEnd" % (block, block)))
+
+    check(nsiscript, filename)
+    for filename, lineno, name in inserts:
+        name = name.strip('"')
+        if (name not in macros and '$' not in name
+                and not name.startswith('MUI_')
+                and not (name.startswith('un.') and name[3:] in macros)):
+            errors.append((filename, lineno,
+                           "!insertmacro of undefined macro %s" % name))
+    return ["%s:%i: %s" % error for error in sorted(errors)]
+
+def get_nsi(target_versions=None, bits=None, features=None,
+            languages=None):
+    # features is None for a script which supports all features, or the
+    # enabled FEATURES, to leave out the script for all others
+    # languages is None for all LANGUAGES, or the list of languages
+    if languages is None:
+        languages = LANGUAGES
     # list all applications
     python_apps = PythonAppInfo.make_apps(target_versions, bits)
     maya_apps = MayaAppInfo.make_apps(target_versions, bits)
@@ -1087,6 +4008,11 @@ def get_nsi(target_versions=None, bits=None):
         BlenderAppInfo.make_apps(target_versions, bits)
         + Blender25xAppInfo.make_apps(target_versions, bits)
         )
+    if features is not None:
+        if 'maya' not in features:
+            maya_apps = []
+        if 'blender' not in features:
+            blender_apps = []
 
     NSI_HEADER = r"""\
 ; @name@ self-installer for Windows
@@ -1098,42 +4024,34 @@ def get_nsi(target_versions=None, bits=None):
 ; Define Application Specific Constants
 ; =====================================
 
-!define PRODUCT_NAME "@name@"
-!define PRODUCT_KEY "@key@"
-!define PRODUCT_VERSION "@version@"
-!define PRODUCT_PUBLISHER "@author@ <@author_email@>"
-!define PRODUCT_WEB_SITE "@url@"
+; PRODUCT_NAME, PRODUCT_KEY, PRODUCT_VERSION, PRODUCT_PUBLISHER,
+; PRODUCT_WEB_SITE, BDIST_NSI_NSH, and the MISC_* feature flags are
+; defined on the makensis command line by bdist_nsi
+!ifndef BDIST_NSI_NSH
+!error "compile with the makensis /D options which bdist_nsi logs"
+!endif
 !define PRODUCT_UNINST_KEY "Software\Microsoft\Windows\CurrentVersion\Uninstall\${PRODUCT_NAME}${PRODUCT_KEY}"
 !define PRODUCT_UNINST_ROOT_KEY "HKLM"
 !define PRODUCT_UNINST_REG_VIEW 32
 !define MISC_SRCDIR "@srcdir@"
 !define MISC_PYSIZEKB "@pysizekb@"
-@compile@!define MISC_COMPILE "1"
-@optimize@!define MISC_OPTIMIZE "1"
-@2to3@!define MISC_2TO3 "1"
-@msvc2005@!define MISC_MSVC2005 "1"
-@msvc2005sp1@!define MISC_MSVC2005SP1 "1"
-@msvc2008@!define MISC_MSVC2008 "1"
-@msvc2008sp1@!define MISC_MSVC2008SP1 "1"
-@maya@!define MISC_MAYA "1"
-@blender@!define MISC_BLENDER "1"
+@hasbaseversion@!define MISC_BASE_VERSION "@baseversion@"
 @hasurl@BrandingText "@url@"
-@hasnshextra@!define MISC_NSHEXTRA "1"
-
-@debug@!define MISC_DEBUG "1"
-
-!ifdef MISC_BLENDER | MISC_MSVC2005 | MISC_MSVC2005SP1 | MISC_MSVC2008 | MISC_MSVC2008SP1
-!define REQUIREOPENLINKNEWWINDOW "1"
-!endif
 
 ; Various Settings
 ; ================
 
 ; solid lzma gives best compression in virtually all cases
-SetCompressor /SOLID lzma
+; (but SetCompress off only works without /SOLID)
+SetCompressor @solid@lzma
 
 Name "${PRODUCT_NAME} ${PRODUCT_VERSION}"
+!ifdef MISC_OUTFILE
+; the temporary file which bdist_nsi renames once makensis succeeds
+OutFile "${MISC_OUTFILE}"
+!else
 OutFile "@installer_path@"
+!endif
 InstallDir "$PROGRAMFILES\${PRODUCT_NAME}${PRODUCT_KEY}"
 ShowInstDetails show
 ShowUnInstDetails show
@@ -1146,6 +4064,7 @@ ShowUnInstDetails show
 !include "MUI2.nsh"
 !include "LogicLib.nsh"
 !include "x64.nsh"
+!include "${BDIST_NSI_NSH}"
 
 
 ; MUI Settings
@@ -1184,69 +4103,17 @@ ShowUnInstDetails show
 ; Languages
 ; =========
 
-!insertmacro MUI_LANGUAGE "English" ;first language is the default language
-!insertmacro MUI_LANGUAGE "French"
-!insertmacro MUI_LANGUAGE "German"
-!insertmacro MUI_LANGUAGE "Spanish"
-!insertmacro MUI_LANGUAGE "SpanishInternational"
-!insertmacro MUI_LANGUAGE "SimpChinese"
-!insertmacro MUI_LANGUAGE "TradChinese"
-!insertmacro MUI_LANGUAGE "Japanese"
-!insertmacro MUI_LANGUAGE "Korean"
-!insertmacro MUI_LANGUAGE "Italian"
-!insertmacro MUI_LANGUAGE "Dutch"
-!insertmacro MUI_LANGUAGE "Danish"
-!insertmacro MUI_LANGUAGE "Swedish"
-!insertmacro MUI_LANGUAGE "Norwegian"
-!insertmacro MUI_LANGUAGE "NorwegianNynorsk"
-!insertmacro MUI_LANGUAGE "Finnish"
-!insertmacro MUI_LANGUAGE "Greek"
-!insertmacro MUI_LANGUAGE "Russian"
-!insertmacro MUI_LANGUAGE "Portuguese"
-!insertmacro MUI_LANGUAGE "PortugueseBR"
-!insertmacro MUI_LANGUAGE "Polish"
-!insertmacro MUI_LANGUAGE "Ukrainian"
-!insertmacro MUI_LANGUAGE "Czech"
-!insertmacro MUI_LANGUAGE "Slovak"
-!insertmacro MUI_LANGUAGE "Croatian"
-!insertmacro MUI_LANGUAGE "Bulgarian"
-!insertmacro MUI_LANGUAGE "Hungarian"
-!insertmacro MUI_LANGUAGE "Thai"
-!insertmacro MUI_LANGUAGE "Romanian"
-!insertmacro MUI_LANGUAGE "Latvian"
-!insertmacro MUI_LANGUAGE "Macedonian"
-!insertmacro MUI_LANGUAGE "Estonian"
-!insertmacro MUI_LANGUAGE "Turkish"
-!insertmacro MUI_LANGUAGE "Lithuanian"
-!insertmacro MUI_LANGUAGE "Slovenian"
-!insertmacro MUI_LANGUAGE "Serbian"
-!insertmacro MUI_LANGUAGE "SerbianLatin"
-!insertmacro MUI_LANGUAGE "Arabic"
-!insertmacro MUI_LANGUAGE "Farsi"
-!insertmacro MUI_LANGUAGE "Hebrew"
-!insertmacro MUI_LANGUAGE "Indonesian"
-!insertmacro MUI_LANGUAGE "Mongolian"
-!insertmacro MUI_LANGUAGE "Luxembourgish"
-!insertmacro MUI_LANGUAGE "Albanian"
-!insertmacro MUI_LANGUAGE "Breton"
-!insertmacro MUI_LANGUAGE "Belarusian"
-!insertmacro MUI_LANGUAGE "Icelandic"
-!insertmacro MUI_LANGUAGE "Malay"
-!insertmacro MUI_LANGUAGE "Bosnian"
-!insertmacro MUI_LANGUAGE "Kurdish"
-!insertmacro MUI_LANGUAGE "Irish"
-!insertmacro MUI_LANGUAGE "Uzbek"
-!insertmacro MUI_LANGUAGE "Galician"
-!insertmacro MUI_LANGUAGE "Afrikaans"
-!insertmacro MUI_LANGUAGE "Catalan"
-!insertmacro MUI_LANGUAGE "Esperanto"
-
-; If you are using solid compression, files that are required before
+""" + "\n".join(
+    '!insertmacro MUI_LANGUAGE "%s"%s'
+    % (language, " ;first language is the default language" if i == 0 else "")
+    for i, language in enumerate(languages)) + r"""
+
+""" + ("" if len(languages) < 2 else r"""; If you are using solid compression, files that are required before
 ; the actual installation should be stored first in the data block,
 ; because this will make your installer start faster.
   
 !insertmacro MUI_RESERVEFILE_LANGDLL
-
+""") + r"""
 
 
 ; Extra header
@@ -1255,6 +4122,15 @@ ShowUnInstDetails show
 !ifdef MISC_NSHEXTRA
 !include "@nshextra@"
 !endif
+!ifdef MISC_COMPONENTS
+
+
+
+; Components
+; ==========
+
+@components@
+!endif
 
 
 
@@ -1262,19 +4138,22 @@ ShowUnInstDetails show
 ; ===============================
 
 ; $0 = full path to python directory (typically, C:\PythonXX)
-; $1 = full path to python executable (typically, C:\PythonXX\python.exe; if empty then compile/optimize/2to3 will be disabled)
+; $1 = full path to python executable (typically, C:\PythonXX\python.exe; if empty then compile/optimize will be disabled)
 ; $2 = python version (e.g. "2.6")
 ; $3 = full path to python package directory (typically, C:\PythonXX\Lib\site-packages)
 ; $4 = full path to python scripts directory (if empty, not installed)
 ; $5 = full path to python include directory (if empty, not installed)
+; $PREVIOUS_INSTALL = version previously installed (if empty, nothing to clean)
 Function InstallFiles
 
   ; first remove any stray files leftover from a previous installation
-@_deletefiles@
+  !insertmacro TIMING_MARK "begin clean $2"
+@_cleanfiles@
 
   !ifdef MISC_NSHEXTRA
   !insertmacro UninstallFilesExtra
   !endif
+  !insertmacro TIMING_MARK "end clean $2"
 
   ; now install all files
 @_files@
@@ -1314,29 +4193,6 @@ FunctionEnd
 ; Macros
 ; ======
 
-
-
-!macro DEBUG_MSG text
-!ifdef MISC_DEBUG
-    MessageBox MB_OK "${text}"
-!endif
-!macroend
-
-; jumps to registry_key_found if the registry key is found
-!macro GET_REGISTRY_KEY variable reg_view reg_root reg_key reg_name if_found
-    !insertmacro DEBUG_MSG "looking for ${reg_root}\${reg_key}\${reg_name} in ${reg_view} bit registry"
-!if "${reg_view}" == "64"
-    ; only check 64 bit registry keys on 64 bit systems
-    ${If} ${RunningX64}
-!endif
-    SetRegView ${reg_view}
-    ReadRegStr ${variable} ${reg_root} ${reg_key} "${reg_name}"
-    IfErrors 0 ${if_found}
-!if "${reg_view}" == "64"
-    ${EndIf}
-!endif
-!macroend
-
 """ + "\n".join(
     "\n".join(app.macro_get_registry_keys())
     for app in python_apps) + r"""
@@ -1351,43 +4207,6 @@ FunctionEnd
     for app in blender_apps) + r"""
 !endif
 
-; get path
-!macro GET_PATH label
-
-    ; check registry
-    ClearErrors
-    !insertmacro GET_REGISTRY_KEYS_${label} registry_key_found_${label}
-    StrCpy $PATH_${label} ""
-    !insertmacro DEBUG_MSG "not found in registry"
-    Goto get_path_end_${label}
-
-registry_key_found_${label}:
-
-    ; remove trailing backslash using the $EXEDIR trick
-    Push $PATH_${label}
-    Exch $EXEDIR
-    Exch $EXEDIR
-    Pop $PATH_${label}
-    !insertmacro DEBUG_MSG "found at $PATH_${label}"
-    !insertmacro GET_PATH_EXTRA_CHECK_${label}
-
-get_path_end_${label}:
-
-!macroend
-
-; validates python path
-!macro GET_PATH_EXTRA_CHECK_PYTHON label
-
-    IfFileExists "$PATH_${label}\python.exe" 0 python_exe_not_found_${label}
-    !insertmacro DEBUG_MSG "found python executable at $PATH_${label}\python.exe"
-    GoTo get_path_end_${label}
-
-python_exe_not_found_${label}:
-
-    !insertmacro DEBUG_MSG "python executable not found"
-    StrCpy $PATH_${label} ""
-!macroend
-
 """ + "\n".join(
     "\n".join(app.macro_get_path_extra_check())
     for app in python_apps) + r"""
@@ -1402,29 +4221,6 @@ python_exe_not_found_${label}:
     for app in blender_apps) + r"""
 !endif
 
-!macro SECTION un name label
-!ifndef HAVE_SECTION_${label}
-!define HAVE_SECTION_${label}
-!endif
-Section "${un}${name}" ${un}section_${label}
-    SetShellVarContext all
-    StrCmp $PATH_${label} "" section_end_${label}
-    !insertmacro SECTION_EXTRA_${label}
-    Call ${un}InstallFiles
-section_end_${label}:
-SectionEnd
-!macroend
-
-; setup install vars for python
-!macro SECTION_EXTRA_PYTHON label py_version
-    StrCpy $0 "$PATH_${label}"
-    StrCpy $1 "$PATH_${label}\python.exe"
-    StrCpy $2 "${py_version}"
-    StrCpy $3 "$PATH_${label}\Lib\site-packages"
-    StrCpy $4 "$PATH_${label}\Scripts"
-    StrCpy $5 "$PATH_${label}\Include"
-!macroend
-
 """ + "\n\n".join(
     "\n".join(app.macro_section_extra())
     for app in python_apps) + r"""
@@ -1439,70 +4235,7 @@ SectionEnd
     for app in blender_apps) + r"""
 !endif
 
-!macro SECTION_SET_PROPERTIES label
-    SectionSetSize ${section_${label}} ${MISC_PYSIZEKB}
-    !insertmacro GET_PATH ${label}
-    StrCmp $PATH_${label} "" 0 +2
-    SectionSetFlags ${section_${label}} ${SF_RO}
-!macroend
-
-
-
-!ifdef MISC_MAYA
-
-; validates python path for maya
-!macro GET_PATH_EXTRA_CHECK_MAYA label
-    IfFileExists $PATH_${label}\bin\mayapy.exe 0 mayapy_exe_not_found_${label}
-    !insertmacro DEBUG_MSG "found python executable at $PATH_${label}\bin\mayapy.exe"
-    GoTo get_path_end_${label}
-
-mayapy_exe_not_found_${label}:
-
-    !insertmacro DEBUG_MSG "python executable not found"
-    StrCpy $PATH_${label} ""
-!macroend
-
-
-; setup install vars for maya
-!macro SECTION_EXTRA_MAYA label py_version
-    StrCpy $0 "$PATH_${label}\Python"
-    StrCpy $1 "$PATH_${label}\bin\mayapy.exe"
-    StrCpy $2 "${py_version}"
-    StrCpy $3 "$PATH_${label}\Python\Lib\site-packages"
-    StrCpy $4 "" ; no scripts
-    StrCpy $5 "" ; no headers
-!macroend
-
-!endif ;MISC_MAYA
-
-
-
 !ifdef MISC_BLENDER
-
-; Blender 24x
-
-!macro CLEAN_STRAY_BLENDER_USER_DATA_FILES path
-    !insertmacro DEBUG_MSG "checking for stray Blender user data files in ${path}"
-    IfFileExists "${path}" 0 +3
-    MessageBox MB_YESNO|MB_ICONQUESTION "Clean stray Blender user data files in ${path} (highly recommended)?" IDNO +2
-    RmDir /r "${path}"
-!macroend
-
-!macro CLEAN_ALL_STRAY_BLENDER_USER_DATA_FILES
-    SetShellVarContext current
-    !insertmacro CLEAN_STRAY_BLENDER_USER_DATA_FILES "$APPDATA\Blender Foundation"
-    SetShellVarContext all
-    !insertmacro CLEAN_STRAY_BLENDER_USER_DATA_FILES "$APPDATA\Blender Foundation"
-    ReadEnvStr $0 "HOME"
-    !insertmacro CLEAN_STRAY_BLENDER_USER_DATA_FILES "$0\.blender"
-!macroend
-
-!macro FILE_EXISTS_BLENDER_SCRIPTS label path if_found if_not_found
-    !insertmacro DEBUG_MSG "checking for blender scripts ${path}"
-    StrCpy $SCRIPTS_${label} "${path}"
-    IfFileExists "$SCRIPTS_${label}\*.*" ${if_found} ${if_not_found}
-!macroend
-
 !macro CHECK_BLENDER_PYTHON_VERSION label py_version if_right if_wrong
     ; dll check for python version
 """ + "\n".join(
@@ -1511,223 +4244,20 @@ mayapy_exe_not_found_${label}:
     Pop $0
     StrCmp $0 ${py_version} ${if_right} ${if_wrong}
 !macroend
-
-; validates path for blender
-!macro GET_PATH_EXTRA_CHECK_BLENDER label py_version
-
-    ; check if blender.exe exists
-    IfFileExists "$PATH_${label}\blender.exe" 0 blender_exe_not_found_${label}
-    !insertmacro DEBUG_MSG "found blender executable at $PATH_${label}\blender.exe"
-
-    !insertmacro CHECK_BLENDER_PYTHON_VERSION ${label} ${py_version} 0 wrong_python_version_${label}
-
-    ; clear variable
-    StrCpy $SCRIPTS_${label} ""
-
-    ; get Blender scripts dir
-    !insertmacro FILE_EXISTS_BLENDER_SCRIPTS ${label} "$PATH_${label}\.blender\scripts" blender_scripts_found_in_install_dir_${label} 0
-; extra sanity check during install: scripts not in default location, so warn, clean, and reinstall blender
-!ifndef __UNINSTALL__
-    MessageBox MB_YESNO|MB_ICONEXCLAMATION "Blender's user data files (such as scripts) do not reside in Blender's installation directory. Blender will sometimes only find its scripts if Blender's user data files reside in Blender's installation directory.$\r$\n$\r$\nDo you wish to abort installation, and first reinstall Blender?" IDNO blender_scripts_notininstallfolder_${label}
-    MessageBox MB_YESNO|MB_ICONQUESTION "Please reinstall Blender, and select 'Use the installation directory' when asked where to install Blender's user data files. When you are done, rerun this installer.$\r$\n$\r$\nVisit the Blender download page?"  IDNO blender_scripts_skip_blender_download_page_${label}
-    StrCpy $0 "http://www.blender.org/download/get-blender/"
-    Call openLinkNewWindow
-blender_scripts_skip_blender_download_page_${label}:
-    Abort ; causes installer to quit
-blender_scripts_notininstallfolder_${label}:
-!endif
-    SetShellVarContext current
-    !insertmacro FILE_EXISTS_BLENDER_SCRIPTS ${label} "$APPDATA\Blender Foundation\Blender\.blender\scripts" blender_scripts_found_${label} 0
-    SetShellVarContext all
-    !insertmacro FILE_EXISTS_BLENDER_SCRIPTS ${label} "$APPDATA\Blender Foundation\Blender\.blender\scripts" blender_scripts_found_${label} 0
-    ReadEnvStr $0 "HOME"
-    !insertmacro FILE_EXISTS_BLENDER_SCRIPTS ${label} "$0\.blender\scripts" blender_scripts_found_${label} blender_scripts_not_found_${label}
-
-blender_scripts_found_in_install_dir_${label}:
-    ; extra cleaning if installing in default directory (only during install)
-!ifndef __UNINSTALL__
-    !insertmacro CLEAN_ALL_STRAY_BLENDER_USER_DATA_FILES
-!endif
-
-blender_scripts_found_${label}:
-    !insertmacro DEBUG_MSG "found blender scripts in $SCRIPTS_${label}"
-    ; remove trailing backslash using the $EXEDIR trick
-    Push $SCRIPTS_${label}
-    Exch $EXEDIR
-    Exch $EXEDIR
-    Pop $SCRIPTS_${label}
-    GoTo blender_scripts_done_${label}
-
-blender_exe_not_found_${label}:
-wrong_python_version_${label}:
-blender_scripts_not_found_${label}:
-    !insertmacro DEBUG_MSG "blender scripts not found"
-    StrCpy $SCRIPTS_${label} ""
-    StrCpy $PATH_${label} ""
-
-blender_scripts_done_${label}:
-!macroend
-
-!macro SECTION_EXTRA_BLENDER label py_version
-    StrCpy $0 "" ; XXX todo: set python path
-    StrCpy $1 "" ; XXX todo: set python executable
-    StrCpy $2 "${py_version}"
-    StrCpy $3 "$SCRIPTS_${label}\bpymodules"
-    StrCpy $4 "" ; no scripts
-    StrCpy $5 "" ; no headers
-!macroend
-
-
-
-; Blender 25x+
-
-!macro GET_PATH_EXTRA_CHECK_BLENDER_25X label py_version version
-    IfFileExists $PATH_${label}\${version}\python\lib\*.* 0 python_lib_not_found_${label}
-    !insertmacro DEBUG_MSG "found python libraries at $PATH_${label}\${version}\python\lib"
-    GoTo get_path_end_${label}
-
-python_lib_not_found_${label}:
-
-    !insertmacro DEBUG_MSG "python libraries not found"
-    StrCpy $PATH_${label} ""
-!macroend
-
-!macro SECTION_EXTRA_BLENDER_25X label py_version version
-    StrCpy $0 "$PATH_${label}\${version}\python"
-    StrCpy $1 "" ; no interpreter
-    StrCpy $2 "${py_version}"
-    # Blender does not have site-packages on its sys.path
-    #StrCpy $3 "$PATH_${label}\${version}\python\lib\site-packages"
-    # instead, we use scripts\addons\modules
-    StrCpy $3 "$PATH_${label}\${version}\scripts\addons\modules"
-    StrCpy $4 "" ; no scripts
-    StrCpy $5 "" ; no headers
-!macroend
-
 !endif ;MISC_BLENDER
 
-
-
-!include "FileFunc.nsh"
-!include "WordFunc.nsh"
-
-!insertmacro Locate
-!insertmacro VersionCompare
-
-!macro SearchDLL DLLLABEL DLLDESC DLLFILE DLLVERSION DLLLINK
-
-Var DLLFound${DLLLABEL}
-
-Function Download${DLLLABEL}
-  Push ${DLLLINK}
-  MessageBox MB_OK "You will need to download ${DLLDESC}. Pressing OK will take you to the download page, please follow the instructions on the page that appears."
-  StrCpy $0 ${DLLLINK}
-  Call openLinkNewWindow
-FunctionEnd
-
-Function LocateCallback${DLLLABEL}
-  MoreInfo::GetProductVersion "$R9"
-  Pop $0
-
-  ${VersionCompare} "$0" "${DLLVERSION}" $R1
-
-  ; $R1 contains the result of the comparison
-  ; 0 = versions are equal
-  ; 1 = first version is newer than second version
-  ; 2 = first version is older than second version
-  StrCmp $R1 2 0 found
-
-  ; version $0 is older than ${DLLVERSION}
-  ;DEBUG;MessageBox MB_OK "${DLLFILE} ($0) is too old."
-  Push "$0"
-  GoTo notfound
-
-found:
-  ; version $0 is equal or newer than ${DLLVERSION}
-  ;DEBUG;MessageBox MB_OK "${DLLFILE} ($0) located!"
-  StrCpy "$0" StopLocate
-  StrCpy $DLLFound${DLLLABEL} "true"
-  Push "$0"
-notfound:
-FunctionEnd
-
-Function Find${DLLLABEL}
-  Push $0
-  Push $1
-
-  DetailPrint "Locating ${DLLDESC}: ${DLLFILE} (${DLLVERSION})."
-
-  StrCpy $1 $WINDIR
-  StrCpy $DLLFound${DLLLABEL} "false"
-  ${Locate} "$1" "/L=F /M=${DLLFILE} /S=0B" "LocateCallback${DLLLABEL}"
-  StrCmp $DLLFound${DLLLABEL} "false" 0 +2
-    Call Download${DLLLABEL}
-
-  Pop $1
-  Pop $0
-FunctionEnd
-!macroend
-
-
-!ifdef MISC_MSVC2005
-!insertmacro SearchDLL "MSVC2005" "Microsoft Visual C++ 2005 Redistributable Package" "MSVCR80.DLL" "8.0.50727.42" "http://www.microsoft.com/en-us/download/details.aspx?id=3387"
-!endif
-
-!ifdef MISC_MSVC2005SP1
-!insertmacro SearchDLL "MSVC2005SP1" "Microsoft Visual C++ 2005 SP1 Redistributable Package" "MSVCR80.DLL" "8.0.50727.762" "http://www.microsoft.com/en-us/download/details.aspx?id=5638"
-!endif
-
-!ifdef MISC_MSVC2008
-!insertmacro SearchDLL "MSVC2008" "Microsoft Visual C++ 2008 Redistributable Package" "MSVCR90.DLL" "9.0.21022.8" "http://www.microsoft.com/en-us/download/details.aspx?id=29"
-!endif
-
-!ifdef MISC_MSVC2008SP1
-!insertmacro SearchDLL "MSVC2008SP1" "Microsoft Visual C++ 2008 SP1 Redistributable Package" "MSVCR90.DLL" "9.0.30729.1" "http://www.microsoft.com/en-us/download/details.aspx?id=5582"
-!endif
 """
 
     NSI_FOOTER = r"""
 ; Functions
 ; =========
 
-!ifdef REQUIREOPENLINKNEWWINDOW
-; taken from http://nsis.sourceforge.net/Open_link_in_new_browser_window
-# uses $0
-Function openLinkNewWindow
-  Push $3 
-  Push $2
-  Push $1
-  Push $0
-  ReadRegStr $0 HKCR "http\shell\open\command" ""
-# Get browser path
-    DetailPrint $0
-  StrCpy $2 '"'
-  StrCpy $1 $0 1
-  StrCmp $1 $2 +2 # if path is not enclosed in " look for space as final char
-    StrCpy $2 ' '
-  StrCpy $3 1
-  loop:
-    StrCpy $1 $0 1 $3
-    DetailPrint $1
-    StrCmp $1 $2 found
-    StrCmp $1 "" found
-    IntOp $3 $3 + 1
-    Goto loop
- 
-  found:
-    StrCpy $1 $0 $3
-    StrCmp $2 " " +2
-      StrCpy $1 '$1"'
- 
-  Pop $0
-  Exec '$1 $0'
-  Pop $1
-  Pop $2
-  Pop $3
-FunctionEnd
+Function .onInit
+!ifdef MISC_INSTALL_TIMING
+  Delete "${TIMING_LOG}"
+  !insertmacro TIMING_MARK "begin init"
 !endif
 
-Function .onInit
   ; Check if user is admin.
   ; Call userInfo plugin to get user info.
   ; The plugin puts the result in the stack.
@@ -1737,23 +4267,27 @@ Function .onInit
   pop $0
 
   ; Compare the result with the string "Admin" to see if the user is admin.
-  ; If match, jump 3 lines down.
-  strCmp $0 "Admin" +3
+  ; If match, jump 4 lines down.
+  strCmp $0 "Admin" +4
   
     ; if there is not a match, print message and return
-    messageBox MB_OK|MB_ICONEXCLAMATION "You require administrator privileges to install ${PRODUCT_NAME} successfully."
+    messageBox MB_OK|MB_ICONEXCLAMATION "You require administrator privileges to install ${PRODUCT_NAME} successfully." /SD IDOK
+    SetErrorLevel ${EXIT_NOT_ADMIN}
     Abort ; quit installer
 
-  ; Language selection.
-  !insertmacro MUI_LANGDLL_DISPLAY
-
+""" + ("" if len(languages) < 2 else r"""  ; Language selection.
+  ${IfNot} ${Silent}
+    !insertmacro MUI_LANGDLL_DISPLAY
+  ${EndIf}
+""") + r"""
 !ifdef MISC_DEBUG
      ${If} ${RunningX64}
          MessageBox MB_OK "running on x64"
      ${EndIf}
 !endif
 
-  ; check python versions
+  ; check python versions, or those on the command line
+  !insertmacro GET_COMMAND_LINE
 """ + "\n".join(
     "    !insertmacro SECTION_SET_PROPERTIES %s"
     % app.label for app in python_apps) + r"""
@@ -1767,10 +4301,37 @@ Function .onInit
     "    !insertmacro SECTION_SET_PROPERTIES %s"
     % app.label for app in blender_apps) + r"""
   !endif ;MISC_BLENDER
+  !insertmacro CHECK_COMMAND_LINE
+  !ifdef MISC_BASE_VERSION
+    ; a patch installer only upgrades targets which have its base release
+    !insertmacro CHECK_BASE_VERSION
+  !endif
 
+  !insertmacro TIMING_MARK "end init"
+FunctionEnd
+
+!ifdef MISC_COMPONENTS
+Function .onSelChange
+""" + "\n".join(
+    "    !insertmacro FOR_EACH_COMPONENT COMPONENT_REQUIRE %s"
+    % app.label for app in python_apps) + r"""
+  !ifdef MISC_MAYA
+""" + "\n".join(
+    "    !insertmacro FOR_EACH_COMPONENT COMPONENT_REQUIRE %s"
+    % app.label for app in maya_apps) + r"""
+  !endif ;MISC_MAYA
+  !ifdef MISC_BLENDER
+""" + "\n".join(
+    "    !insertmacro FOR_EACH_COMPONENT COMPONENT_REQUIRE %s"
+    % app.label for app in blender_apps) + r"""
+  !endif ;MISC_BLENDER
 FunctionEnd
 
+!endif ;MISC_COMPONENTS
 Function un.onInit
+!ifdef MISC_INSTALL_TIMING
+  Delete "${TIMING_LOG}"
+!endif
 """ + "\n".join(
     '    !insertmacro GET_PATH %s' % app.label
     for app in python_apps) + r"""
@@ -1787,6 +4348,7 @@ Function un.onInit
 FunctionEnd
 
 Section -Post
+  !insertmacro TIMING_MARK "begin post"
   SetOutPath "$INSTDIR"
   WriteUninstaller "$INSTDIR\${PRODUCT_NAME}_uninstall.exe"
   SetRegView ${PRODUCT_UNINST_REG_VIEW}
@@ -1816,6 +4378,12 @@ Section -Post
   !ifdef MISC_MSVC2008SP1
   Call FindMSVC2008SP1
   !endif
+
+  !ifdef MISC_INSTALL_TIMING
+  !insertmacro TIMING_MARK "end post"
+  CopyFiles /SILENT "${TIMING_LOG}" "$INSTDIR"
+  Delete "${TIMING_LOG}"
+  !endif
 SectionEnd
 
 Section un.Post
@@ -1824,13 +4392,14 @@ Section un.Post
   !endif
 
   Delete "$INSTDIR\${PRODUCT_NAME}_uninstall.exe"
+  Delete "$INSTDIR\${PRODUCT_NAME}-timing.log"
   RmDir "$INSTDIR"
   SetRegView ${PRODUCT_UNINST_REG_VIEW}
   DeleteRegKey ${PRODUCT_UNINST_ROOT_KEY} "${PRODUCT_UNINST_KEY}"
 SectionEnd
 """
 
-    return (NSI_HEADER
+    nsiscript = (NSI_HEADER
             + "\nSectionGroup /e Python\n"
             + "\n".join(
                 '!insertmacro SECTION "" "%s" %s' % (app.name, app.label)
@@ -1866,6 +4435,18 @@ SectionEnd
             + "\nSectionGroupEnd\n\n\n"
             + "!endif ;MISC_BLENDER\n\n\n"
             + NSI_FOOTER)
+    if features is not None:
+        nsiscript = resolve_ifdefs(
+            nsiscript,
+            defined=["MISC_" + feature.upper() for feature in features],
+            known=["MISC_" + feature.upper() for feature in FEATURES])
+        if 'debug' not in features:
+            nsiscript = re.sub(r'(?m)^\s*!insertmacro DEBUG_MSG .*\n', '',
+                               nsiscript)
+        if 'install_timing' not in features:
+            nsiscript = re.sub(r'(?m)^\s*!insertmacro TIMING_MARK .*\n', '',
+                               nsiscript)
+    return nsiscript
 
 if __name__=='__main__':
     import doctest